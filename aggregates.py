@@ -0,0 +1,356 @@
+import numpy as np
+
+
+def uniform_bin_codes(values, n_bins, lo=None, hi=None):
+    # Same bins as KBinsDiscretizer(strategy='uniform') fitted on the full column, whose range is
+    # passed as lo and hi when only some of its values are coded
+    values = np.asarray(values, dtype=float)
+    lo = values.min() if lo is None else lo
+    hi = values.max() if hi is None else hi
+    if hi == lo:
+        return np.zeros(len(values), dtype=np.int8)
+    edges = np.linspace(lo, hi, n_bins + 1)
+    return np.clip(np.digitize(values, edges[1:-1]), 0, n_bins - 1).astype(np.int8)
+
+
+class BinnedAttributes:
+    # Bin codes for a set of attributes, computed once at load time into an int8 matrix.
+    # Bin counts for any selection of rows are then a single bincount over the selected codes.
+
+    def __init__(self, df, num_bins):
+        self.attributes = list(num_bins)
+        self.num_bins = np.array([num_bins[attribute] for attribute in self.attributes])
+        self.max_bins = int(self.num_bins.max())
+        self.codes = np.column_stack([uniform_bin_codes(df[attribute], num_bins[attribute]) for attribute in self.attributes])
+        self._ranges = [(df[attribute].min(), df[attribute].max()) for attribute in self.attributes]
+        # Offsetting each column by its own block of max_bins lets one bincount cover all attributes
+        self._offsets = (np.arange(len(self.attributes)) * self.max_bins).astype(np.int32)
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def update(self, df, rows):
+        # df holds the data after a change and rows the positions that changed or were appended.
+        # A column whose range is unchanged keeps its bins and only those rows are coded again.
+        codes = np.empty((len(df), len(self.attributes)), dtype=np.int8)
+        codes[:len(self)] = self.codes
+        for i, attribute in enumerate(self.attributes):
+            values = df[attribute].to_numpy()
+            lo, hi = values.min(), values.max()
+            if len(self) and (lo, hi) == self._ranges[i]:
+                codes[rows, i] = uniform_bin_codes(values[rows], self.num_bins[i], lo, hi)
+            else:
+                codes[:, i] = uniform_bin_codes(values, self.num_bins[i])
+            self._ranges[i] = (lo, hi)
+        self.codes = codes
+
+    def counts(self, rows=None):
+        codes = self.codes if rows is None else self.codes[rows]
+        flat = (codes + self._offsets).ravel()
+        return np.bincount(flat, minlength=len(self.attributes) * self.max_bins).reshape(len(self.attributes), self.max_bins)
+
+
+def distribution(counts):
+    # Bin counts per attribute as shares of that attribute's total
+    total = counts.sum(axis=1, keepdims=True)
+    return np.divide(counts, total, out=np.zeros(counts.shape), where=total > 0)
+
+
+class CountCube:
+    # Row counts for every combination of values of the brushable attributes, joined to the bins
+    # of each heatmap attribute. The attributes are low-cardinality (about 2 * 2 * 2 * 21 cells
+    # times 11 * 5 bins), so any combination of histogram brushes is answered by summing cube
+    # cells, in time independent of the number of rows.
+
+    def __init__(self, dimensions, binned):
+        # dimensions maps each brushable attribute to its row codes and its number of values
+        self.dimensions = list(dimensions)
+        self.shape = tuple(n_values for _, n_values in dimensions.values())
+        n_cells = int(np.prod(self.shape))
+        cell = np.ravel_multi_index([np.asarray(codes, dtype=np.intp) for codes, _ in dimensions.values()], self.shape)
+
+        counts = np.empty((n_cells, len(binned.attributes), binned.max_bins), dtype=np.int64)
+        for i in range(len(binned.attributes)):
+            counts[:, i] = np.bincount(cell * binned.max_bins + binned.codes[:, i],
+                                       minlength=n_cells * binned.max_bins).reshape(n_cells, binned.max_bins)
+        self.counts = counts.reshape(*self.shape, len(binned.attributes), binned.max_bins)
+        self.dimension_counts = np.bincount(cell, minlength=n_cells).reshape(self.shape)
+
+    @property
+    def nbytes(self):
+        return self.counts.nbytes + self.dimension_counts.nbytes
+
+    def _cells(self, brushes, skip=None):
+        # brushes maps attributes to a boolean mask over their values, or None when not brushed
+        return np.ix_(*[np.ones(n_values, dtype=bool) if brushes.get(attribute) is None or attribute == skip else brushes[attribute]
+                        for attribute, n_values in zip(self.dimensions, self.shape)])
+
+    def heatmap_counts(self, brushes):
+        return self.counts[self._cells(brushes)].sum(axis=tuple(range(len(self.shape))))
+
+    def histogram_counts(self, attribute, brushes):
+        # Counts per value of one brushable attribute under the brushes on the others
+        axis = self.dimensions.index(attribute)
+        counts = self.dimension_counts[self._cells(brushes, skip=attribute)]
+        return counts.sum(axis=tuple(other for other in range(len(self.shape)) if other != axis))
+
+
+def density_grid(x, y, values, x_range, y_range, bins):
+    # Row counts and value sums per cell of a bins x bins grid, indexed [y, x] like go.Heatmap's z
+    counts, x_edges, y_edges = np.histogram2d(x, y, bins=bins, range=[x_range, y_range])
+    sums, _, _ = np.histogram2d(x, y, bins=bins, range=[x_range, y_range], weights=values)
+    x_centers = (x_edges[:-1] + x_edges[1:]) / 2
+    y_centers = (y_edges[:-1] + y_edges[1:]) / 2
+    return x_centers, y_centers, counts.T, sums.T
+
+
+def split_blocks(mask, block_rows, block_size):
+    # How per-block statistics answer a row mask: the blocks more than half selected are taken
+    # whole, then the selected rows of the other blocks are added and the unselected rows of the
+    # taken blocks removed. Returns (taken blocks, rows to add, rows to remove).
+    mask = np.asarray(mask, dtype=bool)
+    selected = np.add.reduceat(mask, np.arange(0, len(mask), block_size), dtype=np.int64) if len(mask) else np.zeros(0, int)
+    taken = selected * 2 > block_rows
+    in_taken = np.repeat(taken, block_rows)
+    return taken, mask & ~in_taken, ~mask & in_taken
+
+
+class CorrelationBlocks:
+    # Sufficient statistics for correlations over any selection of rows: the row count, column
+    # sums and cross-product matrix of every block of block_size consecutive rows. A selection
+    # adds up the blocks it covers entirely or mostly, then adds the selected rows of its sparse
+    # blocks and subtracts the unselected rows of its mostly selected ones, in one matrix product
+    # each. Only those rows are touched, never a fresh slice of the whole frame. The rows are read
+    # from the (memory-mapped) columns of df, so no copy of the data is kept.
+
+    def __init__(self, df, columns, block_size=4096):
+        self.columns = list(columns)
+        self.block_size = block_size
+        self.values = [df[column].to_numpy() for column in self.columns]
+        self.counts, self.sums, self.cross = self._block_stats(np.arange(self.n_blocks))
+
+    def __len__(self):
+        return len(self.values[0])
+
+    @property
+    def n_blocks(self):
+        return -(-len(self) // self.block_size)
+
+    @property
+    def nbytes(self):
+        # The columns are the dashboard's own and not counted here
+        return self.counts.nbytes + self.sums.nbytes + self.cross.nbytes
+
+    def _rows(self, index):
+        # The columns at the given rows (a slice, indices or a mask) as a rows x columns matrix
+        return np.column_stack([values[index] for values in self.values]).astype(np.float64)
+
+    def _block_stats(self, blocks):
+        k = len(self.columns)
+        counts = np.zeros(len(blocks), dtype=np.int64)
+        sums = np.zeros((len(blocks), k))
+        cross = np.zeros((len(blocks), k, k))
+        for i, block in enumerate(blocks):
+            values = self._rows(slice(block * self.block_size, (block + 1) * self.block_size))
+            counts[i], sums[i], cross[i] = len(values), values.sum(axis=0), values.T @ values
+        return counts, sums, cross
+
+    def update(self, df, rows):
+        # After a data change only the blocks holding changed or appended rows are summed again
+        n_blocks = self.n_blocks
+        self.values = [df[column].to_numpy() for column in self.columns]
+        counts = np.zeros(self.n_blocks, dtype=np.int64)
+        sums = np.zeros((self.n_blocks, len(self.columns)))
+        cross = np.zeros((self.n_blocks, len(self.columns), len(self.columns)))
+        kept = min(n_blocks, self.n_blocks)
+        counts[:kept], sums[:kept], cross[:kept] = self.counts[:kept], self.sums[:kept], self.cross[:kept]
+        changed = np.unique(np.asarray(rows) // self.block_size)
+        counts[changed], sums[changed], cross[changed] = self._block_stats(changed)
+        self.counts, self.sums, self.cross = counts, sums, cross
+
+    def stats(self, mask=None):
+        # (count, column sums, cross products) of the rows in mask, or of every row
+        if mask is None:
+            return self.counts.sum(), self.sums.sum(axis=0), self.cross.sum(axis=0)
+
+        mostly, added, removed = split_blocks(mask, self.counts, self.block_size)
+        count, sums, cross = self.counts[mostly].sum(), self.sums[mostly].sum(axis=0), self.cross[mostly].sum(axis=0)
+        added, removed = self._rows(added), self._rows(removed)
+        count += len(added) - len(removed)
+        sums = sums + added.sum(axis=0) - removed.sum(axis=0)
+        cross = cross + added.T @ added - removed.T @ removed
+        return count, sums, cross
+
+    def correlation(self, mask=None):
+        # Pearson correlation matrix of the columns over the selected rows; NaN where a column is
+        # constant in the selection or fewer than two rows are selected
+        count, sums, cross = self.stats(mask)
+        k = len(self.columns)
+        if count < 2:
+            return np.full((k, k), np.nan)
+        covariance = cross - np.outer(sums, sums) / count
+        std = np.sqrt(np.maximum(np.diag(covariance), 0))
+        scale = np.outer(std, std)
+        return np.clip(np.divide(covariance, scale, out=np.full((k, k), np.nan), where=scale > 1e-9), -1, 1)
+
+
+class AxisBins:
+    # Bin codes of the parallel-coordinates axes, computed once at load time: one bin per value
+    # for attributes with at most max_bins values, uniform bins over the range otherwise. Bins
+    # sit at evenly spaced positions from 0 to 1 along each axis.
+
+    def __init__(self, df, attributes, max_bins=10, seed=0):
+        self.attributes = list(attributes)
+        self.ranges = []
+        num_bins = []
+        codes = []
+        for attribute in self.attributes:
+            values = df[attribute].to_numpy()
+            lo, hi = (int(values.min()), int(values.max())) if len(values) else (0, 0)
+            self.ranges.append((lo, hi))
+            num_bins.append(min(hi - lo + 1, max_bins))
+            codes.append(uniform_bin_codes(values, num_bins[-1]) if len(values) else np.zeros(0, dtype=np.int8))
+        self.num_bins = np.array(num_bins)
+        self.max_bins = int(self.num_bins.max())
+        self.codes = np.column_stack(codes)
+        # A fixed random order of the rows, so the same selection always samples the same lines
+        self.order = np.random.default_rng(seed).permutation(len(self.codes))
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.order.nbytes
+
+    def positions(self, axis):
+        return (np.arange(self.num_bins[axis]) + 0.5) / self.num_bins[axis]
+
+    def bin_labels(self, axis):
+        lo, hi = self.ranges[axis]
+        edges = np.linspace(lo, hi, self.num_bins[axis] + 1)
+        if self.num_bins[axis] == hi - lo + 1:
+            return [str(lo + i) for i in range(self.num_bins[axis])]
+        return [f'{edges[i]:.0f} - {edges[i + 1]:.0f}' for i in range(self.num_bins[axis])]
+
+    def pair_counts(self, rows=None):
+        # Rows per (bin on axis i, bin on axis i + 1), one max_bins x max_bins matrix per pair of neighbouring axes
+        codes = self.codes if rows is None else self.codes[rows]
+        return [np.bincount(codes[:, i].astype(np.int64) * self.max_bins + codes[:, i + 1],
+                            minlength=self.max_bins ** 2).reshape(self.max_bins, self.max_bins)
+                for i in range(len(self.attributes) - 1)]
+
+    def sample(self, mask, size, stratum_axis):
+        # Up to size rows of mask, stratified by their bin on stratum_axis: every bin gets a share
+        # proportional to its selected rows, so rare bins keep their lines
+        rows = self.order[mask[self.order]]
+        if len(rows) <= size:
+            return np.sort(rows)
+        strata = self.codes[rows, stratum_axis]
+        quota = np.ceil(size * np.bincount(strata, minlength=self.num_bins[stratum_axis]) / len(rows)).astype(int)
+        return np.sort(np.concatenate([rows[strata == stratum][:quota[stratum]] for stratum in range(len(quota))]))
+
+    def brush_mask(self, axis_ranges):
+        # Row mask of axis-range brushes, {axis: (low, high)} in positions along the axes
+        mask = np.ones(len(self.codes), dtype=bool)
+        for axis, (low, high) in axis_ranges.items():
+            positions = self.positions(axis)
+            mask &= np.isin(self.codes[:, axis], np.flatnonzero((positions >= min(low, high)) & (positions <= max(low, high))))
+        return mask
+
+
+def quantile(counts, q, lo=0):
+    # The q-quantile of the values lo, lo + 1, ... occurring counts times each, interpolated
+    # linearly between the neighbouring ranks like DataFrame.quantile, without sorting any rows
+    n = counts.sum()
+    if n == 0:
+        return np.nan
+    cumulative = np.cumsum(counts)
+    rank = (n - 1) * q
+    below, above = lo + np.searchsorted(cumulative, [np.floor(rank), np.ceil(rank)], side='right')
+    return float(below + (rank - np.floor(rank)) * (above - below))
+
+
+# Grade filters as in testVis/test_boxplots.py, as conditions on the values given the quartiles and outlier bounds
+QUANTILE_FILTERS = {
+    'outliers': lambda v, q: (v < q['lower_bound']) | (v > q['upper_bound']),
+    'lower_25': lambda v, q: v < q['q1'],
+    'lower_middle': lambda v, q: (v >= q['q1']) & (v < q['median']),
+    'upper_middle': lambda v, q: (v >= q['median']) & (v < q['q3']),
+    'upper_25': lambda v, q: v > q['q3'],
+    'within_IQR': lambda v, q: (v >= q['q1']) & (v <= q['q3']),
+}
+
+
+class BlockQuantiles:
+    # Mergeable quantile sketches of integer columns such as grades and absences: the count of
+    # every value per block of block_size rows. Sketches add up, so the sketch of a selection is
+    # made from the blocks it mostly covers plus and minus its other rows (see split_blocks), and
+    # its quartiles are read off the cumulative counts. On these small value ranges the sketch is
+    # exact and smaller than t-digest or KLL would be.
+
+    def __init__(self, df, columns, block_size=4096):
+        self.columns = list(columns)
+        self.block_size = block_size
+        self.data = {column: df[column].to_numpy() for column in self.columns}
+        self.lo = {column: min(0, int(values.min())) if len(values) else 0 for column, values in self.data.items()}
+        self.n_values = {column: int(values.max()) - self.lo[column] + 1 if len(values) else 1 for column, values in self.data.items()}
+        self.counts = {column: self._block_counts(column, np.arange(self.n_blocks)) for column in self.columns}
+        self.block_rows = np.diff(np.minimum(np.arange(self.n_blocks + 1) * block_size, len(self)))
+
+    def __len__(self):
+        return len(next(iter(self.data.values())))
+
+    @property
+    def n_blocks(self):
+        return -(-len(self) // self.block_size)
+
+    @property
+    def nbytes(self):
+        return sum(counts.nbytes for counts in self.counts.values())
+
+    def _block_counts(self, column, blocks):
+        counts = np.zeros((len(blocks), self.n_values[column]), dtype=np.int64)
+        for i, block in enumerate(blocks):
+            values = self.data[column][block * self.block_size:(block + 1) * self.block_size]
+            counts[i] = np.bincount(values - self.lo[column], minlength=self.n_values[column])
+        return counts
+
+    def update(self, df, rows):
+        # Rows arriving or changing only count the blocks that hold them again, unless they bring
+        # a value outside the range the sketches cover
+        data = {column: df[column].to_numpy() for column in self.columns}
+        if any(len(rows) and (values[rows].min() < self.lo[column] or values[rows].max() >= self.lo[column] + self.n_values[column])
+               for column, values in data.items()):
+            self.__init__(df, self.columns, self.block_size)
+            return
+        n_blocks = self.n_blocks
+        self.data = data
+        changed = np.unique(np.asarray(rows) // self.block_size)
+        block_counts = {}
+        for column in self.columns:
+            counts = np.zeros((self.n_blocks, self.n_values[column]), dtype=np.int64)
+            counts[:n_blocks] = self.counts[column]
+            counts[changed] = self._block_counts(column, changed)
+            block_counts[column] = counts
+        self.counts = block_counts
+        self.block_rows = np.diff(np.minimum(np.arange(self.n_blocks + 1) * self.block_size, len(self)))
+
+    def sketch(self, column, mask=None):
+        # Count of every value of the column over the rows in mask, or over every row
+        if mask is None:
+            return self.counts[column].sum(axis=0)
+        taken, added, removed = split_blocks(mask, self.block_rows, self.block_size)
+        values, lo, n_values = self.data[column], self.lo[column], self.n_values[column]
+        return (self.counts[column][taken].sum(axis=0) + np.bincount(values[added] - lo, minlength=n_values)
+                - np.bincount(values[removed] - lo, minlength=n_values))
+
+    def quartiles(self, column, mask=None):
+        counts = self.sketch(column, mask)
+        q1, median, q3 = (quantile(counts, q, self.lo[column]) for q in (0.25, 0.5, 0.75))
+        return {'count': int(counts.sum()), 'q1': q1, 'median': median, 'q3': q3,
+                'lower_bound': q1 - 1.5 * (q3 - q1), 'upper_bound': q3 + 1.5 * (q3 - q1)}
+
+    def filter_mask(self, column, name, mask=None):
+        # Rows in one of QUANTILE_FILTERS relative to the quartiles of the rows in mask, over all
+        # rows. The condition is evaluated once per possible value and looked up per row.
+        values = self.lo[column] + np.arange(self.n_values[column])
+        in_filter = QUANTILE_FILTERS[name](values, self.quartiles(column, mask))
+        return in_filter[self.data[column] - self.lo[column]]
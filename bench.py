@@ -0,0 +1,227 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+SAMPLE_PATH = 'data/student_data.csv'
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+DEFAULT_FRACTIONS = [0.01, 0.1, 0.5]
+DEFAULT_REPEAT = 5
+# A callback counts as a regression when its median latency grows by more than this factor
+REGRESSION_FACTOR = 1.5
+
+
+def synthetic_students(n_rows, seed=0, sample_path=SAMPLE_PATH):
+    # Rows are drawn from the sample data and their numeric attributes nudged by one step, so the
+    # columns, categories and value ranges match student_data.csv without repeating it exactly
+    import ingest
+
+    rng = np.random.default_rng(seed)
+    sample = pd.read_csv(sample_path)
+    df = sample.iloc[rng.integers(0, len(sample), n_rows)].reset_index(drop=True)
+    for column in ingest.NUMERIC_COLUMNS:
+        nudge = rng.integers(-1, 2, n_rows) * (rng.random(n_rows) < 0.3)
+        df[column] = np.clip(df[column].to_numpy() + nudge, sample[column].min(), sample[column].max())
+    return df
+
+
+def seed_embedding(data_path, cache_dir):
+    # The benchmark measures the callbacks, not t-SNE. A stand-in layout made from the first two
+    # PCA components is cached under the key vaSystem looks up, so the dashboard skips the fit.
+    # It goes into the benchmark's own cache directory, never the one the dashboard serves from.
+    import embedding
+    import ingest
+
+    df = ingest.load_encoded(data_path, cache_dir)
+    key = embedding.embedding_key(data_path, df.columns, embedding.PCA_PARAMS,
+                                  dict(embedding.TSNE_PARAMS, refine_every=embedding.TSNE_REFINE_EVERY))
+    if embedding.load_embedding(key, cache_dir) is None:
+        arrays = embedding.fit_projection(df, embedding.PCA_PARAMS)
+        arrays['tsne'] = arrays['pca'][:, :2] * 10
+        embedding.save_embedding(key, arrays, cache_dir)
+
+
+def grade_brush(grades, fraction):
+    # Highest grades first until the brushed bars cover at least the requested fraction of students
+    values, counts = np.unique(grades, return_counts=True)
+    order = np.argsort(values)[::-1]
+    covered = np.cumsum(counts[order]) / len(grades)
+    chosen = order[:np.searchsorted(covered, fraction) + 1]
+    return {'points': [{'x': int(values[i]), 'y': int(counts[i]), 'binNumber': int(values[i])} for i in chosen]}
+
+
+def tsne_box(layout, fraction):
+    x, y = layout[:, 0], layout[:, 1]
+    x_cut = float(np.quantile(x, fraction))
+    rows = np.flatnonzero(x <= x_cut)
+    return {
+        'points': [{'pointIndex': int(i), 'x': float(x[i]), 'y': float(y[i])} for i in rows],
+        'range': {'x': [float(x.min()), x_cut], 'y': [float(y.min()), float(y.max())]},
+    }
+
+
+def uncached(va, call):
+    # Every measured call starts from an empty view cache, so the numbers reflect the real work
+    def run():
+        va.view_cache.clear()
+        return call()
+    return run
+
+
+def callback_cases(va, fraction, rng):
+    import selection
+
+    n_rows = len(va.df)
+    selected = np.zeros(n_rows, dtype=bool)
+    selected[rng.choice(n_rows, max(1, int(n_rows * fraction)), replace=False)] = True
+    selected_points = selection.encode_selection(selected, va.dataset_version)
+    grades = grade_brush(va.df['G3'].to_numpy(), fraction)
+    gender = {'points': [{'x': 0}]}
+    tsne_selected = tsne_box(np.asarray(va.embedding_job.layout), fraction)
+
+    cases = {
+        'update_tsne_plot': lambda: va.update_tsne_plot(None, gender, None, None, grades, None),
+        'refresh_tsne_plot': lambda: va.refresh_tsne_plot(0, None, None, gender, None, None, grades),
+        'create_heatmap': lambda: va.create_heatmap(selected_points, None, None, None, grades),
+        'create_heatmap_brushed': lambda: va.create_heatmap(None, gender, None, None, grades),
+        'create_correlation': lambda: va.create_correlation(selected_points, None, None, None, None),
+        'create_correlation_brushed': lambda: va.create_correlation(None, gender, None, None, grades),
+        'create_parcoords': lambda: va.create_parcoords(selected_points, None, None, None, None),
+        'store_parcoords_selection': lambda: va.store_parcoords_selection({'range': {'x': [10.5, 11.5], 'y': [0.5, 1]}}),
+        'display_quartiles': lambda: va.display_quartiles(selected_points, 'G3', gender, None, None, None),
+        'apply_quantile_filter': lambda: va.apply_quantile_filter('within_IQR', 'absences', selected_points, None, None, None, None),
+        'store_selected_points': lambda: va.store_selected_points(tsne_selected),
+        'update_higher_histogram': lambda: va.update_higher_histogram(selected_points, None, None, None),
+        'update_higher_histogram_brushed': lambda: va.update_higher_histogram(None, gender, None, grades),
+        'update_gender_histogram': lambda: va.update_gender_histogram(selected_points, None, None, None),
+        'update_cohibition_histogram': lambda: va.update_cohibition_histogram(selected_points, None, None, None),
+        'update_grade_histogram': lambda: va.update_grade_histogram(selected_points, None, None, None),
+        'update_grade_histogram_brushed': lambda: va.update_grade_histogram(None, gender, None, None),
+    }
+    return {name: uncached(va, call) for name, call in cases.items()}
+
+
+def measure(call, repeat):
+    from plotly.io.json import to_json_plotly
+
+    result = call()  # Warm-up, also used for the payload size
+    payload_bytes = len(to_json_plotly(result))
+
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    call()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'latency_ms': {
+            'median': float(np.median(latencies) * 1000),
+            'min': float(np.min(latencies) * 1000),
+            'max': float(np.max(latencies) * 1000),
+        },
+        'peak_memory_bytes': peak,
+        'payload_bytes': payload_bytes,
+    }
+
+
+def run_worker(fractions, repeat, seed):
+    # Runs in a fresh process per dataset size, so the memory numbers of one size do not carry over
+    import vaSystem
+
+    va = vaSystem.Dashboard(os.environ['VA_DATA_PATH'])
+
+    rng = np.random.default_rng(seed)
+    results = []
+    for fraction in fractions:
+        for name, call in callback_cases(va, fraction, rng).items():
+            results.append(dict(size=len(va.df), fraction=fraction, callback=name, **measure(call, repeat)))
+    return results
+
+
+def run(sizes, fractions, repeat, seed, data_dir):
+    os.makedirs(data_dir, exist_ok=True)
+    cache_dir = os.path.join(data_dir, 'cache')  # Holds the stand-in embeddings, see seed_embedding
+    results = []
+    for size in sizes:
+        data_path = os.path.join(data_dir, f'students-{size}-{seed}.csv')
+        if not os.path.exists(data_path):
+            synthetic_students(size, seed).to_csv(data_path, index=False)
+        seed_embedding(data_path, cache_dir)
+
+        with tempfile.NamedTemporaryFile(suffix='.json') as output:
+            subprocess.run(
+                [sys.executable, __file__, '--worker-output', output.name, '--repeat', str(repeat), '--seed', str(seed),
+                 '--fractions', *map(str, fractions)],
+                env=dict(os.environ, VA_DATA_PATH=data_path, VA_CACHE_DIR=cache_dir), check=True,
+            )
+            with open(output.name) as f:
+                size_results = json.load(f)
+
+        for result in size_results:
+            print(f"{result['size']:>8} {result['fraction']:>5} {result['callback']:<28} "
+                  f"{result['latency_ms']['median']:>10.2f} ms {result['peak_memory_bytes'] / 1e6:>9.2f} MB "
+                  f"{result['payload_bytes'] / 1e3:>10.1f} kB")
+        results.extend(size_results)
+    return results
+
+
+def compare(results, baseline):
+    baseline_latency = {(r['size'], r['fraction'], r['callback']): r['latency_ms']['median'] for r in baseline['results']}
+    regressions = []
+    for result in results:
+        before = baseline_latency.get((result['size'], result['fraction'], result['callback']))
+        if before and result['latency_ms']['median'] > before * REGRESSION_FACTOR:
+            regressions.append(result)
+            print(f"Regression: {result['callback']} at {result['size']} rows, fraction {result['fraction']}: "
+                  f"{before:.2f} ms -> {result['latency_ms']['median']:.2f} ms")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the dashboard callbacks on synthetic student data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--fractions', type=float, nargs='+', default=DEFAULT_FRACTIONS)
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=os.path.join('.cache', 'bench'))
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='Earlier results file to check for latency regressions')
+    parser.add_argument('--worker-output', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker_output:
+        with open(args.worker_output, 'w') as f:
+            json.dump(run_worker(args.fractions, args.repeat, args.seed), f)
+        return 0
+
+    results = run(args.sizes, args.fractions, args.repeat, args.seed, args.data_dir)
+    with open(args.output, 'w') as f:
+        json.dump({
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+            'results': results,
+        }, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            return 1 if compare(results, json.load(f)) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+import argparse
+import importlib
+import os
+import sys
+import time
+
+_started = time.perf_counter()
+_import_times = {}
+
+DATA_PATH = os.environ.get('VA_DATA_PATH', 'data/student_data.csv')
+
+
+def timed_import(name):
+    # Heavy modules are imported on the code path that needs them, timed for the import report
+    if name not in sys.modules:
+        start = time.perf_counter()
+        importlib.import_module(name)
+        _import_times[name] = time.perf_counter() - start
+    return sys.modules[name]
+
+
+def import_report():
+    lines = ['Import times:']
+    lines.extend(f'  {name:<24} {seconds * 1000:>8.1f} ms' for name, seconds in _import_times.items())
+    lines.append(f'  {"total until ready":<24} {(time.perf_counter() - _started) * 1000:>8.1f} ms')
+    loaded = [name for name in ('sklearn', 'plotly.express', 'dash') if name in sys.modules]
+    lines.append(f'  heavy modules loaded: {", ".join(loaded) or "none"}')
+    return '\n'.join(lines)
+
+
+def record_import_times():
+    metrics = timed_import('metrics')
+    for name, seconds in _import_times.items():
+        metrics.set_gauge('va_import_seconds', seconds, module=name)
+
+
+def serve(args):
+    va = timed_import('vaSystem')
+    datasets = va.dataset_paths(args.data) if args.data else None
+    memory_budget = va.MEMORY_BUDGET_BYTES if args.memory_budget_mb is None else args.memory_budget_mb * 2**20
+    app = va.create_app(datasets=datasets, memory_budget=memory_budget, watch=args.watch or va.WATCH_DATA)
+    record_import_times()
+    if args.import_report:
+        print(import_report(), file=sys.stderr)
+    app.run(host=args.host, port=args.port, debug=args.debug)
+    return 0
+
+
+def precompute(args):
+    # Fills the data and embedding caches, so later serve runs start without scikit-learn
+    ingest = timed_import('ingest')
+    embedding = timed_import('embedding')
+
+    for data_path in args.data:
+        df = ingest.load_encoded(data_path)
+        job = embedding.EmbeddingJob(data_path, df.select_dtypes(include=['number']))
+        if not job.wait():
+            raise RuntimeError(f'Fitting the embedding of {data_path} failed: {job.error}')
+        print(f'Cached {len(df)} students from {data_path} under {embedding.CACHE_DIR}')
+    if args.import_report:
+        print(import_report(), file=sys.stderr)
+    return 0
+
+
+def run_sweep(args):
+    return timed_import('sweep').main(args.sweep_args)
+
+
+def report(args):
+    return timed_import('report').main(args.report_args)
+
+
+def bench(args):
+    return timed_import('bench').main(args.bench_args)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Student performance dashboard.')
+    parser.add_argument('--import-report', action='store_true', help='Print the time spent importing modules')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = commands.add_parser('serve', help='Run the dashboard')
+    serve_parser.add_argument('--data', nargs='+', help='Data files to serve, one dataset each (default: VA_DATASETS or VA_DATA_PATH)')
+    serve_parser.add_argument('--memory-budget-mb', type=int, help='Memory budget for the loaded datasets (default: VA_MEMORY_BUDGET_MB)')
+    serve_parser.add_argument('--watch', action='store_true', help='Apply new and changed rows of the data files while serving (default: VA_WATCH_DATA)')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8050)
+    serve_parser.add_argument('--debug', action='store_true')
+    serve_parser.set_defaults(run=serve)
+
+    precompute_parser = commands.add_parser('precompute', help='Encode the data and fit the embedding into the cache')
+    precompute_parser.add_argument('--data', nargs='+', default=[DATA_PATH])
+    precompute_parser.set_defaults(run=precompute)
+
+    bench_parser = commands.add_parser('bench', help='Benchmark the callbacks, other arguments are passed on to bench.py')
+    bench_parser.set_defaults(run=bench)
+
+    sweep_parser = commands.add_parser('sweep', help='Fit and score the embedding over a parameter grid, other arguments are passed on to sweep.py')
+    sweep_parser.set_defaults(run=run_sweep)
+
+    report_parser = commands.add_parser('report', help='Render HTML reports of cohorts, other arguments are passed on to report.py')
+    report_parser.set_defaults(run=report)
+
+    args, extra_args = parser.parse_known_args(argv)
+    if extra_args and args.command not in ('bench', 'sweep', 'report'):
+        parser.error(f'unrecognized arguments: {" ".join(extra_args)}')
+    args.bench_args = args.sweep_args = args.report_args = extra_args
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,460 @@
+import contextlib
+import functools
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.environ.get('VA_CACHE_DIR', '.cache')
+CACHE_VERSION = 1
+
+PCA_PARAMS = dict(n_components=5)
+TSNE_PARAMS = dict(n_components=2, perplexity=15, learning_rate=200, random_state=42)
+TSNE_REFINE_EVERY = 250  # t-SNE iterations between layout updates pushed to the dashboard
+
+# sklearn's TSNE refuses fewer iterations than this.
+TSNE_MIN_ITER = 250
+
+# Arrays stored for every cached embedding, one .npy file each so they can be memory-mapped.
+ARRAYS = ['scaled', 'pca', 'tsne', 'scaler_mean', 'scaler_scale', 'pca_components', 'pca_mean']
+
+
+def file_digest(path):
+    # Remembered per file size and modification time, so several caches can key on the same file cheaply
+    stat = os.stat(path)
+    return _file_digest(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=32)
+def _file_digest(path, size, mtime_ns, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def embedding_key(data_path, columns, pca_params, tsne_params):
+    # The embedding is fitted on the encoded columns, so it is keyed by the encoding schema
+    # as well: a changed mapping re-encodes the data under the same column names
+    import ingest
+
+    h = hashlib.sha256()
+    h.update(file_digest(data_path).encode())
+    h.update(json.dumps({
+        'version': CACHE_VERSION,
+        'schema': ingest.ENCODER.key,
+        'columns': list(columns),
+        'pca': pca_params,
+        'tsne': tsne_params,
+    }, sort_keys=True).encode())
+    return h.hexdigest()[:32]
+
+
+def fit_projection(numeric_columns, pca_params):
+    # scikit-learn is only imported when something has to be fitted, a cached embedding does not need it
+    from sklearn.decomposition import PCA
+    from sklearn.preprocessing import StandardScaler
+
+    with metrics.phase('scaling'):
+        scaler = StandardScaler()
+        data_standardized = scaler.fit_transform(numeric_columns)
+
+    with metrics.phase('pca'):
+        pca = PCA(**pca_params)
+        df_pca = pca.fit_transform(data_standardized)
+
+    return {
+        'scaled': data_standardized,
+        'pca': df_pca,
+        'scaler_mean': scaler.mean_,
+        'scaler_scale': scaler.scale_,
+        'pca_components': pca.components_,
+        'pca_mean': pca.mean_,
+    }
+
+
+def run_tsne(df_pca, tsne_params, refine_every=None, on_layout=None):
+    with metrics.phase('tsne'):
+        return _run_tsne(df_pca, tsne_params, refine_every, on_layout)
+
+
+def _run_tsne(df_pca, tsne_params, refine_every, on_layout):
+    from sklearn.manifold import TSNE
+
+    if not refine_every:
+        return TSNE(**tsne_params).fit_transform(df_pca)
+
+    # sklearn only returns the final layout, so the optimisation is split into stages.
+    # The first stage runs the 250 early exaggeration iterations, every following stage
+    # continues from the previous layout without exaggeration.
+    params = dict(tsne_params)
+    total_iter = params.pop('max_iter', 1000)
+    refine_every = max(refine_every, TSNE_MIN_ITER)
+
+    layout = TSNE(**dict(params, max_iter=TSNE_MIN_ITER)).fit_transform(df_pca)
+    done_iter = TSNE_MIN_ITER
+    while done_iter < total_iter:
+        if on_layout is not None:
+            on_layout(layout)
+        step = max(TSNE_MIN_ITER, min(refine_every, total_iter - done_iter))
+        layout = TSNE(**dict(params, init=layout, early_exaggeration=1, max_iter=step)).fit_transform(df_pca)
+        done_iter += step
+
+    return layout
+
+
+def compute_embedding(numeric_columns, pca_params, tsne_params, refine_every=None):
+    arrays = fit_projection(numeric_columns, pca_params)
+    arrays['tsne'] = run_tsne(arrays['pca'], tsne_params, refine_every)
+    return arrays
+
+
+def load_embedding(key, cache_dir=CACHE_DIR):
+    path = os.path.join(cache_dir, key)
+    if not all(os.path.exists(os.path.join(path, f'{name}.npy')) for name in ARRAYS):
+        metrics.inc('va_cache_requests_total', cache='embedding', result='miss')
+        return None
+    metrics.inc('va_cache_requests_total', cache='embedding', result='hit')
+    return {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in ARRAYS}
+
+
+def save_embedding(key, arrays, cache_dir=CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write into a temporary directory first so a crash never leaves a half-written entry behind.
+    tmp = tempfile.mkdtemp(dir=cache_dir, prefix=f'.{key}-')
+    try:
+        for name in ARRAYS:
+            np.save(os.path.join(tmp, f'{name}.npy'), np.ascontiguousarray(arrays[name]))
+        os.replace(tmp, os.path.join(cache_dir, key))
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if load_embedding(key, cache_dir) is None:
+            raise
+
+
+def load_or_compute_embedding(data_path, numeric_columns, pca_params, tsne_params, refine_every=None, cache_dir=CACHE_DIR):
+    key = embedding_key(data_path, numeric_columns.columns, pca_params, dict(tsne_params, refine_every=refine_every))
+    arrays = load_embedding(key, cache_dir)
+    if arrays is None:
+        save_embedding(key, compute_embedding(numeric_columns, pca_params, tsne_params, refine_every), cache_dir)
+        arrays = load_embedding(key, cache_dir)
+    return arrays
+
+
+def _acquire_lock(path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    for _ in range(2):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if _lock_alive(path):
+                return False
+            # Left behind by a process that died, take it over
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            continue
+        with os.fdopen(fd, 'w') as f:
+            f.write(str(os.getpid()))
+        return True
+    return False
+
+
+def _lock_alive(path):
+    try:
+        with open(path) as f:
+            pid = int(f.read() or 0)  # Empty while the owner is still writing its pid
+    except FileNotFoundError:
+        return False
+    except ValueError:
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class EmbeddingJob:
+    # Serves the cached embedding if there is one. Otherwise it fits the scaler and PCA
+    # right away, uses the first two PCA components as a placeholder layout and runs
+    # t-SNE on a background thread, publishing the layout after every refinement stage.
+    #
+    # When several server processes start on the same data, only the process holding the
+    # lock file fits t-SNE. It also writes every intermediate layout next to the cache, and
+    # the other processes pick those up, and finally the cached embedding, in poll().
+
+    def __init__(self, data_path, numeric_columns, pca_params=PCA_PARAMS, tsne_params=TSNE_PARAMS,
+                 refine_every=TSNE_REFINE_EVERY, cache_dir=CACHE_DIR):
+        self.key = embedding_key(data_path, numeric_columns.columns, pca_params, dict(tsne_params, refine_every=refine_every))
+        self.cache_dir = cache_dir
+        self.version = 0
+        self._tsne_args = (tsne_params, refine_every)
+        self._lock_path = os.path.join(cache_dir, f'{self.key}.lock')
+        self._progress_path = os.path.join(cache_dir, f'{self.key}.progress.npy')
+        self._progress_mtime = None
+        self._owner_pid = None
+        self._thread = None
+        self.error = None  # Why the last t-SNE fit in this process failed; the placeholder layout stays
+
+        cached = load_embedding(self.key, cache_dir)
+        if cached is not None:
+            self.arrays = cached
+            self.layout = cached['tsne']
+            self.done = True
+            return
+
+        self.arrays = fit_projection(numeric_columns, pca_params)
+        self.layout = np.asarray(self.arrays['pca'][:, :2])
+        self.done = False
+        self._start_if_unowned()
+
+    def _start_if_unowned(self):
+        if _acquire_lock(self._lock_path):
+            self._owner_pid = os.getpid()
+            self.error = None
+            self._thread = threading.Thread(target=self._run, args=self._tsne_args, daemon=True)
+            self._thread.start()
+
+    def _publish(self, layout):
+        self.layout = layout
+        self.version += 1
+
+    def _publish_progress(self, layout):
+        self._publish(layout)
+        tmp = f'{self._progress_path}.{os.getpid()}.npy'
+        np.save(tmp, layout)
+        os.replace(tmp, self._progress_path)
+
+    def _run(self, tsne_params, refine_every):
+        try:
+            tsne_results = run_tsne(self.arrays['pca'], tsne_params, refine_every, self._publish_progress)
+            self.arrays = dict(self.arrays, tsne=tsne_results)
+            save_embedding(self.key, self.arrays, self.cache_dir)
+            self.done = True
+            self._publish(tsne_results)
+        except Exception as e:
+            # Not done: the PCA placeholder stays on screen with the error in the title
+            logger.exception('t-SNE fit for embedding %s failed', self.key)
+            metrics.inc('va_embedding_failures_total')
+            self.error = f'{type(e).__name__}: {e}'
+            self.version += 1
+        finally:
+            for path in (self._progress_path, self._lock_path):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+
+    def poll(self):
+        # Processes that do not fit t-SNE themselves (including workers forked from the process
+        # that does) follow its progress through the cache directory
+        if self.done or self._owner_pid == os.getpid():
+            return
+
+        if os.path.exists(os.path.join(self.cache_dir, self.key, 'tsne.npy')):
+            cached = load_embedding(self.key, self.cache_dir)
+            if cached is not None:
+                self.arrays = cached
+                self.done = True
+                self._publish(cached['tsne'])
+                return
+
+        try:
+            mtime = os.stat(self._progress_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime is not None and mtime != self._progress_mtime:
+            self._progress_mtime = mtime
+            with contextlib.suppress(OSError, ValueError):
+                self._publish(np.load(self._progress_path))
+        elif not _lock_alive(self._lock_path):
+            self._start_if_unowned()
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.done and (deadline is None or time.monotonic() < deadline):
+            if self._thread is not None and self._owner_pid == os.getpid():
+                self._thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+                if self.error is not None:
+                    break
+            else:
+                self.poll()
+                time.sleep(0.5)
+        return self.done
+
+
+class StoredEmbedding:
+    # An embedding that is already in the cache, e.g. from a parameter sweep, with the same
+    # interface as EmbeddingJob so the dashboard can show either
+
+    def __init__(self, key, arrays):
+        self.key = key
+        self.arrays = arrays
+        self.layout = arrays['tsne']
+        self.version = 0
+        self.done = True
+        self.error = None
+
+    def poll(self):
+        pass
+
+    def wait(self, timeout=None):
+        return True
+
+
+class UpdatedEmbedding:
+    # The embedding after rows of the data changed or were appended under a running dashboard,
+    # with the same interface as EmbeddingJob. The changed rows are placed into the previous
+    # layout with Projection, so the students that did not change stay where they are. Once the
+    # share of rows placed that way since the last fit passes drift_threshold, t-SNE is refitted
+    # in the background and its layout replaces the projected one when it is done.
+
+    def __init__(self, previous, data_path, numeric_columns, rows, drift_threshold, perplexity=TSNE_PARAMS['perplexity']):
+        self.key = previous.key
+        self.version = previous.version + 1
+        self._data = (data_path, numeric_columns)
+        self._refit = None
+
+        fitted = dict(previous.arrays, tsne=previous.layout)
+        projection = Projection(fitted, perplexity)
+        numeric_rows = numeric_columns.to_numpy()[rows]
+        placed = {'scaled': projection.scale(numeric_rows), 'pca': projection.pca_transform(numeric_rows),
+                  'tsne': projection.transform(numeric_rows)}
+
+        self.arrays = dict(fitted)
+        for name, values in placed.items():
+            array = np.empty((len(numeric_columns), fitted[name].shape[1]))
+            array[:len(fitted[name])] = fitted[name]
+            array[rows] = values
+            self.arrays[name] = array
+        self.layout = self.arrays['tsne']
+
+        self.projected = np.zeros(len(numeric_columns), dtype=bool)
+        previous_projected = getattr(previous, 'projected', None)
+        if previous_projected is not None:
+            self.projected[:len(previous_projected)] = previous_projected
+        self.projected[rows] = True
+        self.done = True
+        if self.drift > drift_threshold:
+            self.refit()
+
+    @property
+    def error(self):
+        return None if self._refit is None else self._refit.error
+
+    @property
+    def drift(self):
+        return float(self.projected.mean()) if len(self.projected) else 0.0
+
+    def refit(self):
+        data_path, numeric_columns = self._data
+        self._refit = EmbeddingJob(data_path, numeric_columns)
+        self.done = False
+        self.poll()
+
+    def poll(self):
+        if self._refit is None or self.done:
+            return
+        self._refit.poll()
+        if self._refit.done:
+            self.key = self._refit.key
+            self.arrays = self._refit.arrays
+            self.layout = self.arrays['tsne']
+            self.projected = np.zeros(len(self.layout), dtype=bool)
+            self.version += 1
+            self.done = True
+
+    def wait(self, timeout=None):
+        if self._refit is not None:
+            self._refit.wait(timeout)
+        self.poll()
+        return self.done
+
+
+def neighbor_affinities(distances, perplexity, n_steps=50):
+    # Gaussian affinities over each row's neighbours, with the bandwidth found by bisection
+    # so that every row has the requested perplexity (as in the t-SNE fit itself)
+    sq_distances = distances ** 2
+    target = np.log(perplexity)
+    beta = np.ones(len(distances))
+    lo = np.zeros(len(distances))
+    hi = np.full(len(distances), np.inf)
+    for _ in range(n_steps):
+        p = np.exp(-(sq_distances - sq_distances[:, :1]) * beta[:, None])
+        p /= p.sum(axis=1, keepdims=True)
+        entropy = -(p * np.log(np.maximum(p, 1e-12))).sum(axis=1)
+        too_flat = entropy > target
+        lo = np.where(too_flat, beta, lo)
+        hi = np.where(too_flat, hi, beta)
+        beta = np.where(np.isinf(hi), beta * 2, (lo + hi) / 2)
+    return p
+
+
+class Projection:
+    # Places new students into an existing embedding without refitting it. New rows go through
+    # the fitted scaler and PCA, then each new point is optimised on the t-SNE objective against
+    # its nearest neighbours in PCA space while every existing point stays where it is.
+
+    def __init__(self, arrays, perplexity=TSNE_PARAMS['perplexity'], n_iter=100, learning_rate=1):
+        from sklearn.neighbors import NearestNeighbors
+
+        self.arrays = arrays
+        self.perplexity = min(perplexity, (len(arrays['pca']) - 1) / 3)
+        self.n_neighbors = min(int(3 * self.perplexity) + 1, len(arrays['pca']))
+        self.n_iter = n_iter
+        self.learning_rate = learning_rate
+        self.neighbors = NearestNeighbors(n_neighbors=self.n_neighbors).fit(arrays['pca'])
+
+    def scale(self, numeric_rows):
+        numeric_rows = np.asarray(numeric_rows, dtype=float)
+        if numeric_rows.shape[1] != len(self.arrays['scaler_mean']):
+            raise ValueError(f"Expected {len(self.arrays['scaler_mean'])} encoded columns, got {numeric_rows.shape[1]}")
+        return (numeric_rows - self.arrays['scaler_mean']) / self.arrays['scaler_scale']
+
+    def pca_transform(self, numeric_rows):
+        return (self.scale(numeric_rows) - self.arrays['pca_mean']) @ np.asarray(self.arrays['pca_components']).T
+
+    def transform(self, numeric_rows):
+        distances, indices = self.neighbors.kneighbors(self.pca_transform(numeric_rows))
+        p = neighbor_affinities(distances, self.perplexity)
+
+        tsne = np.asarray(self.arrays['tsne'])
+        neighbor_layout = tsne[indices]  # (rows, neighbours, 2)
+        layout = (p[:, :, None] * neighbor_layout).sum(axis=1)
+
+        # Gradient descent on KL(P || Q), with Q normalised over each point's neighbours
+        update = np.zeros_like(layout)
+        for _ in range(self.n_iter):
+            diff = layout[:, None, :] - neighbor_layout
+            w = 1 / (1 + (diff ** 2).sum(axis=2))
+            q = w / w.sum(axis=1, keepdims=True)
+            grad = 4 * (((p - q) * w)[:, :, None] * diff).sum(axis=1)
+            update = 0.8 * update - self.learning_rate * grad
+            layout = layout + update
+        return layout
+
+
+def project_csv(data_path, arrays, perplexity=TSNE_PARAMS['perplexity'], chunk_size=100000):
+    # Batch entry point: encodes a CSV of new students with the ingest schema and returns
+    # the encoded rows with their position in the existing embedding
+    import pandas as pd
+    import ingest
+
+    projection = Projection(arrays, perplexity)
+    frames = []
+    for chunk in pd.read_csv(data_path, dtype=ingest.CSV_DTYPES, usecols=list(ingest.SCHEMA), chunksize=chunk_size):
+        encoded = pd.DataFrame(ingest.ENCODER.encode(chunk), copy=False)
+        layout = projection.transform(encoded.to_numpy())
+        frames.append(encoded.assign(**{'tsne-1': layout[:, 0], 'tsne-2': layout[:, 1]}))
+    return pd.concat(frames, ignore_index=True)
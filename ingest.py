@@ -0,0 +1,306 @@
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import zlib
+
+import numpy as np
+import pandas as pd
+
+import embedding
+import metrics
+
+CHUNK_SIZE = 100000
+
+# Declarative schema of data/student_data.csv, see the attribute descriptions in the README,
+# in the order of the file's columns. It is compiled once into ENCODER below.
+#   ('numeric', dtype): stored as is in the smallest integer type that holds its range
+#   ('binary', (value encoded as 0, value encoded as 1))
+#   ('one_hot', categories): one 0/1 column per category except the first
+SCHEMA = {
+    'school': ('binary', ('GP', 'MS')),
+    'sex': ('binary', ('F', 'M')),
+    'age': ('numeric', 'int8'),
+    'address': ('binary', ('U', 'R')),
+    'famsize': ('binary', ('LE3', 'GT3')),
+    'Pstatus': ('binary', ('T', 'A')),
+    'Medu': ('numeric', 'int8'),
+    'Fedu': ('numeric', 'int8'),
+    'Mjob': ('one_hot', ('at_home', 'health', 'other', 'services', 'teacher')),
+    'Fjob': ('one_hot', ('at_home', 'health', 'other', 'services', 'teacher')),
+    'reason': ('one_hot', ('course', 'home', 'other', 'reputation')),
+    'guardian': ('one_hot', ('father', 'mother', 'other')),
+    'traveltime': ('numeric', 'int8'),
+    'studytime': ('numeric', 'int8'),
+    'failures': ('numeric', 'int8'),
+    'schoolsup': ('binary', ('no', 'yes')),
+    'famsup': ('binary', ('no', 'yes')),
+    'paid': ('binary', ('no', 'yes')),
+    'activities': ('binary', ('no', 'yes')),
+    'nursery': ('binary', ('no', 'yes')),
+    'higher': ('binary', ('no', 'yes')),
+    'internet': ('binary', ('no', 'yes')),
+    'romantic': ('binary', ('no', 'yes')),
+    'famrel': ('numeric', 'int8'),
+    'freetime': ('numeric', 'int8'),
+    'goout': ('numeric', 'int8'),
+    'Dalc': ('numeric', 'int8'),
+    'Walc': ('numeric', 'int8'),
+    'health': ('numeric', 'int8'),
+    'absences': ('numeric', 'int16'),
+    'G1': ('numeric', 'int8'),
+    'G2': ('numeric', 'int8'),
+    'G3': ('numeric', 'int8'),
+}
+
+
+class Encoder:
+    # The schema compiled into a fixed column layout and the lookups to fill it. The layout
+    # only depends on the schema, never on the categories a file happens to contain: columns
+    # encoded as one value keep their schema order and the one-hot columns follow them, as
+    # get_dummies(drop_first=True) laid them out before.
+
+    def __init__(self, schema=SCHEMA):
+        self.schema = schema
+        self.csv_dtypes = {}
+        self._codes = {}  # Source column -> {category: code}, for single rows
+        steps, one_hot = [], []
+        for column, (kind, arg) in schema.items():
+            if kind == 'numeric':
+                self.csv_dtypes[column] = arg
+                steps.append((column, kind, [column], np.dtype(arg)))
+            elif kind in ('binary', 'one_hot'):
+                self.csv_dtypes[column] = pd.CategoricalDtype(list(arg))
+                self._codes[column] = {value: code for code, value in enumerate(arg)}
+                if kind == 'binary':
+                    steps.append((column, kind, [column], np.dtype(np.int8)))
+                else:
+                    one_hot.append((column, kind, [f'{column}_{value}' for value in arg[1:]], np.dtype(np.int8)))
+            else:
+                raise ValueError(f"Unknown encoding '{kind}' for column '{column}'")
+        self._steps = [(column, kind, outputs) for column, kind, outputs, _ in steps + one_hot]
+        self.dtypes = {output: dtype for _, _, outputs, dtype in steps + one_hot for output in outputs}
+        self.columns = list(self.dtypes)
+        # Part of the cache path, so encoded columns are rebuilt when the schema changes
+        self.key = hashlib.sha256(json.dumps(schema).encode()).hexdigest()[:16]
+
+    def categories(self, column):
+        kind, arg = self.schema[column]
+        if kind == 'numeric':
+            raise ValueError(f"Column '{column}' is numeric and has no fixed categories")
+        return list(arg)
+
+    def rows_where(self, df, filters):
+        # Row mask of the encoded frame for filters on the CSV columns, e.g. {'school': ['GP'], 'age': [17, 18]}
+        mask = np.ones(len(df), dtype=bool)
+        for column, values in filters.items():
+            if column not in self.schema:
+                raise ValueError(f"Unknown column '{column}'")
+            kind, arg = self.schema[column]
+            if kind == 'numeric':
+                mask &= np.isin(df[column].to_numpy(), values)
+                continue
+            unknown = [value for value in values if value not in self._codes[column]]
+            if unknown:
+                raise ValueError(f"Unexpected value {unknown[0]!r} in column '{column}', expected one of {list(arg)}")
+            codes = [self._codes[column][value] for value in values]
+            if kind == 'binary':
+                mask &= np.isin(df[column].to_numpy(), codes)
+            else:
+                # The first category is the row without any of the one-hot columns set
+                one_hot = np.column_stack([df[f'{column}_{value}'].to_numpy() for value in arg[1:]])
+                mask &= np.isin(one_hot.argmax(axis=1) + one_hot.any(axis=1), codes)
+        return mask
+
+    def allocate(self, n_rows):
+        return {column: np.empty(n_rows, dtype=dtype) for column, dtype in self.dtypes.items()}
+
+    def encode(self, chunk, out=None, start=0):
+        # Encodes a chunk read with csv_dtypes into out[column][start:start + len(chunk)],
+        # writing every output column once and without intermediate copies
+        if out is None:
+            out, start = self.allocate(len(chunk)), 0
+        rows = slice(start, start + len(chunk))
+        for column, kind, outputs in self._steps:
+            if kind == 'numeric':
+                out[column][rows] = chunk[column].to_numpy()
+                continue
+            codes = chunk[column].cat.codes.to_numpy()
+            if (codes < 0).any():
+                raise ValueError(f"Unexpected value in column '{column}', expected one of {list(self._codes[column])}")
+            if kind == 'binary':
+                out[column][rows] = codes
+            else:
+                for code, output in enumerate(outputs, start=1):
+                    np.equal(codes, code, out=out[output][rows], casting='unsafe')
+        return out
+
+    def encode_frame(self, df):
+        # Raw rows, e.g. from pd.read_csv without dtypes, into a DataFrame in the encoded layout
+        return pd.DataFrame(self.encode(df.astype(self.csv_dtypes)), copy=False)
+
+    def encode_row(self, row):
+        # A single incoming student, as a mapping of CSV column to value, into one encoded row
+        encoded = np.zeros(len(self.columns), dtype=np.int16)
+        position = 0
+        for column, kind, outputs in self._steps:
+            value = row[column]
+            if kind == 'numeric':
+                encoded[position] = int(value)
+            else:
+                code = self._codes[column].get(value)
+                if code is None:
+                    raise ValueError(f"Unexpected value in column '{column}', expected one of {list(self._codes[column])}")
+                if kind == 'binary':
+                    encoded[position] = code
+                elif code > 0:
+                    encoded[position + code - 1] = 1
+            position += len(outputs)
+        return encoded
+
+
+ENCODER = Encoder()
+CSV_DTYPES = ENCODER.csv_dtypes
+NUMERIC_COLUMNS = {column: dtype for column, (kind, dtype) in SCHEMA.items() if kind == 'numeric'}
+
+
+def count_rows(data_path, chunk_size=1 << 20):
+    # Data rows of a CSV file, to size the output before it is parsed
+    newlines, last = 0, b'\n'
+    with open(data_path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            newlines += chunk.count(b'\n')
+            last = chunk[-1:]
+    return newlines + (last != b'\n') - 1
+
+
+def read_encoded(data_path, out=None, chunk_size=CHUNK_SIZE, encoder=ENCODER):
+    # One pass over the file, each chunk encoded straight into its rows of the preallocated columns
+    if out is None:
+        out = encoder.allocate(count_rows(data_path))
+    n_rows = len(next(iter(out.values())))
+    start = 0
+    with metrics.phase('csv_load'):
+        for chunk in pd.read_csv(data_path, dtype=encoder.csv_dtypes, usecols=list(encoder.schema), chunksize=chunk_size):
+            if start + len(chunk) > n_rows:
+                raise ValueError(f'{data_path} has more rows than lines')
+            encoder.encode(chunk, out, start)
+            start += len(chunk)
+    # Blank lines are skipped by the parser, so the columns can be longer than the data
+    return {column: values[:start] for column, values in out.items()}
+
+
+def write_encoded(data_path, path, encoder=ENCODER):
+    # The columns are preallocated as .npy files and the chunks encoded straight into them
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=parent, prefix='.encoded-')
+    try:
+        n_rows = count_rows(data_path)
+        files = [os.path.join(tmp, f'{i}.npy') for i in range(len(encoder.columns))]
+        out = {column: np.lib.format.open_memmap(file, mode='w+', dtype=dtype, shape=(n_rows,))
+               for file, (column, dtype) in zip(files, encoder.dtypes.items())}
+        columns = read_encoded(data_path, out, encoder=encoder)
+        for values in out.values():
+            values.flush()
+        if len(next(iter(columns.values()))) < n_rows:
+            columns = {column: np.array(values) for column, values in columns.items()}
+            out = None
+            for file, values in zip(files, columns.values()):
+                np.save(file, values)
+        with open(os.path.join(tmp, 'columns.json'), 'w') as f:
+            json.dump(encoder.columns, f)
+        os.replace(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.exists(os.path.join(path, 'columns.json')):
+            raise
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+
+def load_encoded(data_path, cache_dir=embedding.CACHE_DIR, encoder=ENCODER):
+    # The encoded columns are cached as one .npy file per column and memory-mapped on later runs
+    path = os.path.join(cache_dir, f'encoded-{embedding.file_digest(data_path)[:32]}-{encoder.key}')
+    if not os.path.exists(os.path.join(path, 'columns.json')):
+        metrics.inc('va_cache_requests_total', cache='encoded', result='miss')
+        write_encoded(data_path, path, encoder)
+    else:
+        metrics.inc('va_cache_requests_total', cache='encoded', result='hit')
+
+    with open(os.path.join(path, 'columns.json')) as f:
+        names = json.load(f)
+    columns = {name: np.load(os.path.join(path, f'{i}.npy'), mmap_mode='r') for i, name in enumerate(names)}
+    return pd.DataFrame(columns, copy=False)
+
+
+def read_lines(data_path):
+    # Header and data lines of a CSV file. A last line without its newline is still being
+    # appended and left for the next read; blank lines are skipped as the parser skips them.
+    with open(data_path, 'rb') as f:
+        data = f.read()
+    header, *lines = data[:data.rfind(b'\n') + 1].splitlines()
+    return header, [line for line in lines if line.strip()]
+
+
+def line_hashes(lines):
+    return np.fromiter((zlib.crc32(line) for line in lines), dtype=np.uint32, count=len(lines))
+
+
+class DeltaReader:
+    # Follows a data file that changes while it is served, e.g. when new grades are appended or
+    # corrected. It keeps a hash of every data line, so after a change only the lines that are
+    # new or differ are parsed and encoded. Rows are matched by line number, which holds for
+    # files without quoted line breaks like student_data.csv.
+
+    def __init__(self, data_path, encoder=ENCODER):
+        self.data_path = data_path
+        self.encoder = encoder
+        self._stat = self.stat()
+        self.header, lines = read_lines(data_path)
+        self.hashes = line_hashes(lines)
+
+    def stat(self):
+        stat = os.stat(self.data_path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def changed(self):
+        return self.stat() != self._stat
+
+    @property
+    def version(self):
+        # Fingerprint of the rows as last read, whatever the file looks like by now
+        return hashlib.blake2b(self.header + self.hashes.tobytes(), digest_size=8).hexdigest()
+
+    def read_delta(self):
+        # (rows, encoded columns of those rows), with rows the changed and appended row numbers in
+        # the new file. None when rows were removed or the header changed, which needs a full reload.
+        self._stat = self.stat()
+        header, lines = read_lines(self.data_path)
+        hashes = line_hashes(lines)
+        previous_header, previous = self.header, self.hashes
+        self.header, self.hashes = header, hashes
+        if header != previous_header or len(hashes) < len(previous):
+            return None
+
+        rows = np.concatenate([np.flatnonzero(hashes[:len(previous)] != previous), np.arange(len(previous), len(hashes))])
+        if len(rows) == 0:
+            return rows, self.encoder.allocate(0)
+        csv = b'\n'.join([header, *(lines[row] for row in rows)])
+        chunk = pd.read_csv(io.BytesIO(csv), dtype=self.encoder.csv_dtypes, usecols=list(self.encoder.schema))
+        return rows, self.encoder.encode(chunk)
+
+
+def apply_delta(df, rows, encoded):
+    # The encoded frame with the delta from DeltaReader.read_delta written over and after its rows
+    n_rows = max(len(df), int(rows.max()) + 1) if len(rows) else len(df)
+    columns = {}
+    for column in df.columns:
+        values = np.empty(n_rows, dtype=df[column].dtype)
+        values[:len(df)] = df[column].to_numpy()
+        values[rows] = encoded[column]
+        columns[column] = values
+    return pd.DataFrame(columns, copy=False)
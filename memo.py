@@ -0,0 +1,218 @@
+import contextlib
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import metrics
+
+
+def selection_key(n_rows, rows=None):
+    # Canonical fingerprint of a set of rows: a mask and an index list selecting the same
+    # students give the same key, whatever order the indices came in
+    if rows is None:
+        return 'all'
+    rows = np.asarray(rows)
+    if rows.dtype != bool:
+        mask = np.zeros(n_rows, dtype=bool)
+        mask[rows] = True
+        rows = mask
+    return hashlib.blake2b(np.packbits(rows).tobytes(), digest_size=16).hexdigest()
+
+
+def approx_size(value):
+    # Rough memory footprint of a callback result, counting the arrays and strings it holds
+    if hasattr(value, 'to_plotly_json'):
+        value = value.to_plotly_json()
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(approx_size(k) + approx_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return 8 * len(value) + sum(approx_size(v) for v in value)
+    return 8
+
+
+class ViewCache:
+    # LRU cache of derived views (figures and patches) keyed by view name, selection fingerprint
+    # and dataset version, bounded by the approximate size of the cached values
+
+    def __init__(self, max_bytes, version=None):
+        self.max_bytes = max_bytes
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def set_version(self, version):
+        # A new dataset version makes every cached view stale
+        if version != self.version:
+            self.version = version
+            self.clear()
+
+    def get_or_compute(self, key, compute):
+        key = json.dumps([self.version, key])
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if entry is not None:
+            metrics.inc('va_cache_requests_total', cache='views', result='hit')
+            return entry[0]
+
+        self.misses += 1
+        metrics.inc('va_cache_requests_total', cache='views', result='miss')
+        value = compute()
+        size = approx_size(value)
+        if size > self.max_bytes:
+            return value
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (value, size)
+                self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+            metrics.set_gauge('va_view_cache_bytes', self.size)
+        return value
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self), 'bytes': self.size, 'max_bytes': self.max_bytes}
+
+
+class ReadWriteLock:
+    # Any number of readers, or one writer. Waiting writers go first, so a steady stream of
+    # readers cannot hold one off forever.
+
+    def __init__(self):
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+        self._cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def read(self):
+        with self._cond:
+            while self._writing or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+
+class LazyPool:
+    # Values built on first use, such as one dashboard per dataset. Once their total size is over
+    # max_bytes the least recently used ones are dropped; the value just asked for is always kept.
+
+    def __init__(self, build, max_bytes, size=approx_size, name='pool'):
+        self.build = build
+        self.max_bytes = max_bytes
+        self.size = size
+        self.name = name
+        self._values = OrderedDict()
+        self._sizes = {}  # Size of each value, measured when it was built or last resized
+        self._building = {}  # Lock per key being built
+        self._lock = threading.Lock()  # Guards _values and _building only, never held while building
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def _cached(self, key):
+        with self._lock:
+            value = self._values.get(key)
+            if value is not None:
+                self._values.move_to_end(key)
+                metrics.inc('va_cache_requests_total', cache=self.name, result='hit')
+            return value
+
+    def get(self, key):
+        value = self._cached(key)
+        if value is not None:
+            return value
+        with self._lock:
+            build_lock = self._building.setdefault(key, threading.Lock())
+
+        # Concurrent requests for a cold key build it only once, while other keys stay served
+        with build_lock:
+            value = self._cached(key)
+            if value is not None:
+                return value
+            metrics.inc('va_cache_requests_total', cache=self.name, result='miss')
+            try:
+                value = self.build(key)
+                size = self.size(value)
+            except BaseException:
+                with self._lock:
+                    self._building.pop(key, None)
+                raise
+            # Published and unmarked as building at once, so a request in between cannot build it again
+            with self._lock:
+                self._values[key] = value
+                self._sizes[key] = size
+                self._building.pop(key, None)
+                self._evict()
+        return value
+
+    def resize(self, key):
+        # Measures a value again after it grew or shrank, e.g. when a dashboard picked up new data.
+        # Sizes are only measured here and when a value is built, never under the lock.
+        value = self._values.get(key)
+        if value is None:
+            return
+        size = self.size(value)
+        with self._lock:
+            if self._values.get(key) is value and self._sizes.get(key) != size:
+                self._sizes[key] = size
+                self._evict()
+
+    def _evict(self):
+        # Called with the lock held, after an insert or a size change
+        total = sum(self._sizes.values())
+        while total > self.max_bytes and len(self._values) > 1:
+            key, _ = self._values.popitem(last=False)
+            total -= self._sizes.pop(key)
+        metrics.set_gauge('va_pool_entries', len(self._values), pool=self.name)
+        metrics.set_gauge('va_pool_bytes', total, pool=self.name)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': list(self._values), 'bytes': sum(self._sizes.values()), 'max_bytes': self.max_bytes}
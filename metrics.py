@@ -0,0 +1,164 @@
+import contextlib
+import functools
+import os
+import threading
+import time
+from collections import defaultdict, deque
+
+import numpy as np
+
+# Set VA_METRICS=0 to disable. Callbacks are then registered unwrapped and no /metrics route exists.
+ENABLED = os.environ.get('VA_METRICS', '1') != '0'
+
+# Quantiles are computed over this many most recent observations of each summary
+RESERVOIR_SIZE = 1024
+QUANTILES = [0.5, 0.95, 0.99]
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_gauges = {}
+_summaries = {}
+_help = {
+    'va_callback_calls_total': ('counter', 'Dash callback invocations.'),
+    'va_callback_exceptions_total': ('counter', 'Dash callbacks that raised an exception.'),
+    'va_callback_latency_seconds': ('summary', 'Dash callback latency.'),
+    'va_callback_output_bytes': ('summary', 'Serialized size of the Dash callback response.'),
+    'va_cache_requests_total': ('counter', 'Cache lookups by cache and result.'),
+    'va_embedding_failures_total': ('counter', 't-SNE fits that raised an exception.'),
+    'va_startup_phase_seconds': ('gauge', 'Duration of the last run of each startup phase.'),
+    'va_view_cache_bytes': ('gauge', 'Approximate size of the cached derived views.'),
+    'va_pool_entries': ('gauge', 'Values currently held by each lazily built pool.'),
+    'va_pool_bytes': ('gauge', 'Approximate size of the values held by each pool.'),
+    'va_import_seconds': ('gauge', 'Time spent importing each module loaded on demand at startup.'),
+}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+
+def set_gauge(name, value, **labels):
+    if not ENABLED:
+        return
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    if not ENABLED:
+        return
+    with _lock:
+        summary = _summaries.get(_key(name, labels))
+        if summary is None:
+            summary = _summaries[_key(name, labels)] = {'recent': deque(maxlen=RESERVOIR_SIZE), 'sum': 0.0, 'count': 0}
+        summary['recent'].append(value)
+        summary['sum'] += value
+        summary['count'] += 1
+
+
+def phase(name):
+    if not ENABLED:
+        return contextlib.nullcontext()
+    return _timed_phase(name)
+
+
+@contextlib.contextmanager
+def _timed_phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        set_gauge('va_startup_phase_seconds', time.perf_counter() - start, phase=name)
+
+
+def _format_labels(labels, **extra):
+    labels = labels + tuple(extra.items())
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+def render():
+    lines = []
+    with _lock:
+        series = defaultdict(list)
+        for (name, labels), value in _counters.items():
+            series[name].append(f'{name}{_format_labels(labels)} {value:g}')
+        for (name, labels), value in _gauges.items():
+            series[name].append(f'{name}{_format_labels(labels)} {value:g}')
+        for (name, labels), summary in _summaries.items():
+            for q, value in zip(QUANTILES, np.quantile(list(summary['recent']), QUANTILES)):
+                series[name].append(f'{name}{_format_labels(labels, quantile=q)} {value:g}')
+            series[name].append(f'{name}_sum{_format_labels(labels)} {summary["sum"]:g}')
+            series[name].append(f'{name}_count{_format_labels(labels)} {summary["count"]}')
+
+    for name in sorted(series):
+        kind, description = _help.get(name, ('untyped', ''))
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        lines.extend(series[name])
+    return '\n'.join(lines) + '\n'
+
+
+def _timed_callback(func):
+    import flask
+    from dash.exceptions import PreventUpdate
+
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if flask.has_request_context():
+            flask.g.va_callback = name
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except PreventUpdate:
+            raise
+        except Exception:
+            inc('va_callback_exceptions_total', callback=name)
+            raise
+        finally:
+            inc('va_callback_calls_total', callback=name)
+            observe('va_callback_latency_seconds', time.perf_counter() - start, callback=name)
+
+    return wrapper
+
+
+def instrument(app):
+    # Must run before the callbacks are registered: every function decorated with app.callback
+    # afterwards is registered through a timing wrapper, while the module keeps the plain function
+    if not ENABLED:
+        return
+    import flask
+
+    register = app.callback
+
+    def callback(*args, **kwargs):
+        decorate = register(*args, **kwargs)
+
+        def wrap(func):
+            decorate(_timed_callback(func))
+            return func
+
+        return wrap
+
+    app.callback = callback
+
+    @app.server.after_request
+    def record_output_size(response):
+        name = flask.g.pop('va_callback', None)
+        if name is not None:
+            observe('va_callback_output_bytes', response.calculate_content_length() or 0, callback=name)
+        return response
+
+    @app.server.route('/metrics')
+    def serve_metrics():
+        return flask.Response(render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,140 @@
+import argparse
+import html
+import itertools
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+DATA_PATH = os.environ.get('VA_DATA_PATH', 'data/student_data.csv')
+DEFAULT_OUTPUT_DIR = 'reports'
+CHUNK_SIZE = 8  # Cohorts per task sent to a worker
+
+REPORT_TEMPLATE = '''<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>{title}</title></head>
+<body>
+<h1>{title}</h1>
+<p>{count} of {total} students ({share:.1f}%)</p>
+{figures}
+</body>
+</html>
+'''
+
+# Set in each worker by init_worker, so the dataset and the embedding are loaded once per process
+_dashboard = None
+
+
+def expand_specs(specs, encoder):
+    # A spec is {"name": ..., "where": {column: [values]}, "each": [columns]}: the students
+    # matching every "where" filter, split into one cohort per combination of the values of the
+    # "each" columns. Columns and values are those of the CSV, e.g. {"school": ["GP"]}.
+    cohorts = []
+    for spec in specs:
+        where = spec.get('where', {})
+        each = spec.get('each', [])
+        for combination in itertools.product(*[encoder.categories(column) for column in each]):
+            filters = dict(where, **{column: [value] for column, value in zip(each, combination)})
+            # Unnamed cohorts are named after all their filters, so they get distinct files
+            named = zip(each, combination) if spec.get('name') else filters.items()
+            parts = [spec['name']] if spec.get('name') else []
+            parts += [f"{column}={','.join(map(str, value)) if isinstance(value, list) else value}" for column, value in named]
+            cohorts.append({'name': ' '.join(parts) or 'all students', 'where': filters})
+    return cohorts
+
+
+def file_name(name):
+    return re.sub(r'[^A-Za-z0-9=.,_-]+', '_', name).strip('_') or 'report'
+
+
+def report_path(cohort, output_dir):
+    return os.path.join(output_dir, f"{file_name(cohort['name'])}.html")
+
+
+def cohort_figures(dashboard, selected):
+    # The views of the live app for a fixed selection of students, built by the same methods
+    import plotly.graph_objects as go
+
+    figures = [dashboard.create_tsne_figure(selected)]
+    for attribute, figure in dashboard.histogram_figures.items():
+        figures.append(go.Figure(figure).update_traces(y=dashboard.bin_masks[attribute].counts(selected)))
+    figures.append(dashboard.create_heatmap_figure(dashboard.heatmap_bins.counts(selected)))
+    return figures
+
+
+def render_report(dashboard, cohort):
+    import plotly.io as pio
+
+    selected = dashboard.cohort_rows(cohort['where'])
+    count = int(np.count_nonzero(selected))
+    # plotly.js is inlined once per file, so every report opens without network access
+    figures = [pio.to_html(figure, full_html=False, include_plotlyjs=i == 0)
+               for i, figure in enumerate(cohort_figures(dashboard, selected))]
+    return REPORT_TEMPLATE.format(title=html.escape(cohort['name']), count=count, total=len(selected),
+                                  share=100 * count / max(len(selected), 1), figures='\n'.join(figures))
+
+
+def init_worker(data_path):
+    global _dashboard
+    import vaSystem
+
+    # The encoded data and the embedding are memory-mapped from the cache the parent filled,
+    # so the workers share one copy of them
+    _dashboard = vaSystem.Dashboard(data_path, watch=False)
+
+
+def render_to_file(cohort, output_dir):
+    path = report_path(cohort, output_dir)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(render_report(_dashboard, cohort))
+    return path
+
+
+def run(data_path, specs, output_dir, workers=None):
+    import ingest
+    import vaSystem
+
+    cohorts = expand_specs(specs, ingest.ENCODER)
+    paths = {}
+    for cohort in cohorts:
+        path = report_path(cohort, output_dir)
+        if path in paths:
+            raise ValueError(f"Cohorts {paths[path]!r} and {cohort['name']!r} would both be written to {path}; give them distinct names")
+        paths[path] = cohort['name']
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Load once up front so the data and embedding caches are filled before the workers start
+    dashboard = vaSystem.Dashboard(data_path, watch=False)
+    if not dashboard.embedding_job.wait():
+        raise RuntimeError(f'Fitting the embedding of {data_path} failed: {dashboard.embedding_job.error}')
+    for cohort in cohorts:
+        dashboard.cohort_rows(cohort['where'])  # Fails on an unknown column or value before any work is done
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(data_path,)) as pool:
+        paths = list(pool.map(render_to_file, cohorts, itertools.repeat(output_dir), chunksize=CHUNK_SIZE))
+    seconds = time.perf_counter() - start
+    print(f'Rendered {len(paths)} reports into {output_dir} in {seconds:.1f} s ({len(paths) / seconds:.1f} reports/s)')
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render the dashboard views of predefined cohorts into HTML reports.')
+    parser.add_argument('specs', help='JSON file with a list of cohort specs, see expand_specs')
+    parser.add_argument('--data', default=DATA_PATH)
+    parser.add_argument('--output-dir', default=DEFAULT_OUTPUT_DIR)
+    parser.add_argument('--workers', type=int, help='Worker processes (default: one per core)')
+    args = parser.parse_args(argv)
+
+    with open(args.specs) as f:
+        specs = json.load(f)
+    run(args.data, specs, args.output_dir, args.workers)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,180 @@
+import base64
+import zlib
+
+import numpy as np
+
+
+class BinMasks:
+    # One precomputed boolean row mask per distinct value of an attribute, so a brush
+    # over any set of histogram bars is a single vectorized OR over the stored masks.
+
+    def __init__(self, values):
+        self.values, codes = np.unique(np.asarray(values), return_inverse=True)
+        self.codes = codes.astype(np.int8 if len(self.values) <= 127 else np.int32)
+        self.masks = self.codes.reshape(1, -1) == np.arange(len(self.values)).reshape(-1, 1)
+        self.totals = np.bincount(self.codes, minlength=len(self.values))
+
+    def __len__(self):
+        return self.masks.shape[1]
+
+    def counts(self, rows=None):
+        if rows is None:
+            return self.totals.copy()
+        return np.bincount(self.codes[rows], minlength=len(self.values))
+
+    def update(self, values, rows):
+        # values is the whole column after the data changed and rows the positions that changed or
+        # were appended. Only those rows are coded again, unless they bring a value without a bar yet.
+        values = np.asarray(values)
+        new_values = values[rows]
+        idx = np.searchsorted(self.values, new_values)
+        if (idx >= len(self.values)).any() or (self.values[np.minimum(idx, len(self.values) - 1)] != new_values).any():
+            self.__init__(values)
+            return
+
+        old_rows = rows[rows < len(self)]
+        totals = self.totals - np.bincount(self.codes[old_rows], minlength=len(self.values))
+        codes = np.empty(len(values), dtype=self.codes.dtype)
+        codes[:len(self)] = self.codes
+        codes[rows] = idx
+        masks = np.empty((len(self.values), len(values)), dtype=bool)
+        masks[:, :len(self)] = self.masks
+        masks[:, rows] = idx.reshape(1, -1) == np.arange(len(self.values)).reshape(-1, 1)
+        self.codes, self.masks, self.totals = codes, masks, totals + np.bincount(idx, minlength=len(self.values))
+
+    def value_mask(self, values):
+        # Which of the attribute's values are brushed, or None when nothing is
+        if values is None:
+            return None
+        return np.isin(self.values, values)
+
+    def select(self, values):
+        return self.select_mask(self.value_mask(values))
+
+    def select_mask(self, value_mask):
+        if not value_mask.any():
+            return np.zeros(len(self), dtype=bool)
+        return np.any(self.masks[value_mask], axis=0)
+
+
+def selected_bin_values(selected_data):
+    # Histogram bars are centered on the integer value they count, so the bar position is the value
+    if not selected_data or not selected_data.get('points'):
+        return None
+    return np.rint([point['x'] for point in selected_data['points']]).astype(int)
+
+
+def points_in_polygon(x, y, polygon):
+    # Even-odd ray casting, vectorized over the points and looping over the polygon edges
+    polygon = np.asarray(polygon, dtype=float)
+    inside = np.zeros(len(x), dtype=bool)
+    x0, y0 = polygon[-1]
+    for x1, y1 in polygon:
+        crosses = (y0 > y) != (y1 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+        inside ^= crosses & (x < x_cross)
+        x0, y0 = x1, y1
+    return inside
+
+
+class GridIndex:
+    # Uniform grid over 2D points, with the row indices sorted by cell. Each grid row is then one
+    # contiguous run of the sorted points, so a box or lasso query only tests the points in the
+    # cells its bounding box overlaps instead of every row.
+
+    def __init__(self, x, y, points_per_cell=16, max_cells=1024):
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        self.n_rows = len(x)
+        self.cells = int(np.clip(np.sqrt(self.n_rows / points_per_cell), 1, max_cells))
+        self.x_min, self.y_min = (float(x.min()), float(y.min())) if self.n_rows else (0.0, 0.0)
+        self.x_width = max(float(x.max()) - self.x_min, 1e-12) / self.cells if self.n_rows else 1.0
+        self.y_width = max(float(y.max()) - self.y_min, 1e-12) / self.cells if self.n_rows else 1.0
+
+        cell = self._cell(y, self.y_min, self.y_width) * self.cells + self._cell(x, self.x_min, self.x_width)
+        self.order = np.argsort(cell, kind='stable')
+        self.cell_start = np.concatenate([[0], np.cumsum(np.bincount(cell, minlength=self.cells ** 2))])
+        self.sorted_x = x[self.order]
+        self.sorted_y = y[self.order]
+
+    def _cell(self, values, origin, width):
+        return np.clip(((values - origin) // width).astype(np.int64), 0, self.cells - 1)
+
+    def _candidates(self, x0, x1, y0, y1):
+        # Positions in the sorted order of the points in all cells overlapping the box
+        if self.n_rows == 0 or x1 < self.x_min or y1 < self.y_min:
+            return np.zeros(0, dtype=np.int64)
+        ix0, ix1 = self._cell(np.array([x0, x1]), self.x_min, self.x_width)
+        iy0, iy1 = self._cell(np.array([y0, y1]), self.y_min, self.y_width)
+        rows = np.arange(iy0, iy1 + 1) * self.cells
+        starts, ends = self.cell_start[rows + ix0], self.cell_start[rows + ix1 + 1]
+        lengths = ends - starts
+        if lengths.sum() == 0:
+            return np.zeros(0, dtype=np.int64)
+        # Concatenated ranges starts[i]:ends[i] without a Python loop over the grid rows
+        offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+        return np.arange(lengths.sum()) + offsets
+
+    def box(self, x0, x1, y0, y1):
+        x0, x1, y0, y1 = min(x0, x1), max(x0, x1), min(y0, y1), max(y0, y1)
+        positions = self._candidates(x0, x1, y0, y1)
+        px, py = self.sorted_x[positions], self.sorted_y[positions]
+        return np.sort(self.order[positions[(px >= x0) & (px <= x1) & (py >= y0) & (py <= y1)]])
+
+    def lasso(self, polygon):
+        polygon = np.asarray(polygon, dtype=float)
+        (x0, y0), (x1, y1) = polygon.min(axis=0), polygon.max(axis=0)
+        positions = self._candidates(x0, x1, y0, y1)
+        inside = points_in_polygon(self.sorted_x[positions], self.sorted_y[positions], polygon)
+        return np.sort(self.order[positions[inside]])
+
+    def region_rows(self, selected_data):
+        # Resolves a box or lasso selection against every row, including rows the client never drew
+        if selected_data.get('range'):
+            (x0, x1), (y0, y1) = selected_data['range']['x'], selected_data['range']['y']
+            return self.box(x0, x1, y0, y1)
+        if selected_data.get('lassoPoints'):
+            lasso = selected_data['lassoPoints']
+            return self.lasso(np.column_stack([lasso['x'], lasso['y']]))
+        return None
+
+    def region_mask(self, selected_data):
+        rows = self.region_rows(selected_data)
+        if rows is None:
+            return None
+        mask = np.zeros(self.n_rows, dtype=bool)
+        mask[rows] = True
+        return mask
+
+
+def encode_selection(mask, version):
+    # Selected rows as a bitset for dcc.Store, one bit per row. Box and lasso selections are long
+    # runs of equal bits, so the bitset is deflated whenever that makes it smaller. The dataset
+    # version tag lets consumers drop a selection made on other data.
+    mask = np.asarray(mask, dtype=bool)
+    packed = np.packbits(mask).tobytes()
+    deflated = zlib.compress(packed, 1)
+    encoding, data = ('deflate', deflated) if len(deflated) < len(packed) else ('bits', packed)
+    return {
+        'version': version,
+        'rows': len(mask),
+        'count': int(np.count_nonzero(mask)),
+        'encoding': encoding,
+        'data': base64.b64encode(data).decode('ascii'),
+    }
+
+
+def decode_selection(payload, version=None):
+    # Row mask of a stored selection, or None for no selection or one made on another dataset version
+    if not payload or (version is not None and payload['version'] != version):
+        return None
+    data = base64.b64decode(payload['data'])
+    if payload['encoding'] == 'deflate':
+        data = zlib.decompress(data)
+    return np.unpackbits(np.frombuffer(data, dtype=np.uint8), count=payload['rows']).view(bool)
+
+
+def selection_count(payload, version=None):
+    if not payload or (version is not None and payload['version'] != version):
+        return 0
+    return payload['count']
@@ -0,0 +1,132 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import embedding
+
+DEFAULT_PCA_COMPONENTS = [2, 5, 10]
+DEFAULT_PERPLEXITIES = [5, 15, 30, 50]
+DEFAULT_LEARNING_RATES = [100, 200, 500]
+# Quality is scored on a fixed sample of rows, since trustworthiness is quadratic in the rows
+SCORE_SAMPLE = 2000
+SCORE_NEIGHBORS = 10
+
+
+def results_path(data_path, cache_dir=embedding.CACHE_DIR):
+    return os.path.join(cache_dir, f'sweep-{embedding.file_digest(data_path)[:32]}.json')
+
+
+def load_results(data_path, cache_dir=embedding.CACHE_DIR):
+    # Scored sweep runs of a data file, best trustworthiness first; empty before the first sweep
+    try:
+        with open(results_path(data_path, cache_dir)) as f:
+            results = json.load(f)
+    except FileNotFoundError:
+        return []
+    return sorted(results, key=lambda result: -result['trustworthiness'])
+
+
+def save_results(data_path, results, cache_dir=embedding.CACHE_DIR):
+    path = results_path(data_path, cache_dir)
+    tmp = f'{path}.{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump(results, f, indent=2)
+    os.replace(tmp, path)
+
+
+def score(scaled, layout, grades, seed=0):
+    from sklearn.manifold import trustworthiness
+    from sklearn.neighbors import NearestNeighbors
+
+    rows = np.arange(len(layout))
+    if len(rows) > SCORE_SAMPLE:
+        rows = np.sort(np.random.default_rng(seed).choice(rows, SCORE_SAMPLE, replace=False))
+    scaled, layout, grades = np.asarray(scaled)[rows], np.asarray(layout)[rows], np.asarray(grades, dtype=float)[rows]
+    n_neighbors = min(SCORE_NEIGHBORS, len(rows) // 2 - 1)
+
+    # How well the final grade of a student is predicted by the mean grade of their nearest
+    # neighbours in the embedding (leave one out), in grade points
+    _, neighbors = NearestNeighbors(n_neighbors=n_neighbors + 1).fit(layout).kneighbors(layout)
+    knn_g3_error = np.abs(grades[neighbors[:, 1:]].mean(axis=1) - grades).mean()
+
+    return {
+        'trustworthiness': float(trustworthiness(scaled, layout, n_neighbors=n_neighbors)),
+        'knn_g3_mae': float(knn_g3_error),
+    }
+
+
+def run_one(data_path, pca_params, tsne_params, cache_dir=embedding.CACHE_DIR):
+    # One grid point, run in a pool worker. The embedding is cached like the dashboard's own,
+    # keyed by the data file and the parameters, so a repeated sweep only scores it again.
+    import ingest
+
+    df = ingest.load_encoded(data_path, cache_dir)
+    key = embedding.embedding_key(data_path, df.columns, pca_params, dict(tsne_params, refine_every=None))
+    start = time.perf_counter()
+    arrays = embedding.load_or_compute_embedding(data_path, df, pca_params, tsne_params, cache_dir=cache_dir)
+    seconds = time.perf_counter() - start
+
+    return dict(
+        key=key,
+        pca_params=pca_params,
+        tsne_params=tsne_params,
+        seconds=seconds,
+        **score(arrays['scaled'], arrays['tsne'], df['G3'].to_numpy()),
+    )
+
+
+def grid(pca_components, perplexities, learning_rates):
+    for n_components, perplexity, learning_rate in itertools.product(pca_components, perplexities, learning_rates):
+        yield (dict(embedding.PCA_PARAMS, n_components=n_components),
+               dict(embedding.TSNE_PARAMS, perplexity=perplexity, learning_rate=learning_rate))
+
+
+def run(data_path, pca_components, perplexities, learning_rates, workers=None, cache_dir=embedding.CACHE_DIR):
+    import ingest
+
+    ingest.load_encoded(data_path, cache_dir)  # Encode once up front, the workers then share the cached columns
+
+    results = {result['key']: result for result in load_results(data_path, cache_dir)}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_one, data_path, pca_params, tsne_params, cache_dir)
+                   for pca_params, tsne_params in grid(pca_components, perplexities, learning_rates)]
+        for future in futures:
+            result = future.result()
+            # A run that came from the cache keeps the wall time of its original fit
+            if result['key'] in results:
+                result['seconds'] = results[result['key']]['seconds']
+            results[result['key']] = result
+            print(f"pca {result['pca_params']['n_components']:>3} perplexity {result['tsne_params']['perplexity']:>5} "
+                  f"learning rate {result['tsne_params']['learning_rate']:>5}: trustworthiness {result['trustworthiness']:.3f} "
+                  f"kNN G3 error {result['knn_g3_mae']:.2f} in {result['seconds']:.1f} s")
+            save_results(data_path, list(results.values()), cache_dir)
+    return load_results(data_path, cache_dir)
+
+
+def number(value):
+    # 15 and not 15.0, so the parameters hash to the same cache key as when given from Python
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fit and score the embedding over a grid of parameters.')
+    parser.add_argument('--data', default=os.environ.get('VA_DATA_PATH', 'data/student_data.csv'))
+    parser.add_argument('--pca-components', type=int, nargs='+', default=DEFAULT_PCA_COMPONENTS)
+    parser.add_argument('--perplexities', type=number, nargs='+', default=DEFAULT_PERPLEXITIES)
+    parser.add_argument('--learning-rates', type=number, nargs='+', default=DEFAULT_LEARNING_RATES)
+    parser.add_argument('--workers', type=int, help='Worker processes (default: one per core)')
+    args = parser.parse_args(argv)
+
+    run(args.data, args.pca_components, args.perplexities, args.learning_rates, args.workers)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
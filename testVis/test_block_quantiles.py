@@ -0,0 +1,55 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Checks the quartile filters' block sketches (see aggregates.BlockQuantiles) against pandas
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import aggregates
+import ingest
+import vaSystem
+
+rng = np.random.default_rng(0)
+block_size = 64  # Small blocks make a selection take whole blocks, add rows and remove rows at once
+
+
+def random_masks(n_rows):
+    # Random selections, from a handful of students to nearly all of them
+    return [rng.random(n_rows) < share for share in (0.01, 0.1, 0.5, 0.9, 0.99)] + [np.ones(n_rows, dtype=bool)]
+
+
+def check_quartiles(quantiles, df):
+    for column in vaSystem.quantile_columns:
+        for mask in random_masks(len(df)):
+            values = df[column][mask]
+            quartiles = quantiles.quartiles(column, mask)
+            assert quartiles['count'] == len(values)
+            for name, q in (('q1', 0.25), ('median', 0.5), ('q3', 0.75)):
+                assert np.isclose(quartiles[name], values.quantile(q), equal_nan=True), (column, name)
+
+            # Filters over every row, relative to the selection's quartiles as in testVis/test_boxplots.py
+            q1, q3 = values.quantile(0.25), values.quantile(0.75)
+            column_values = df[column].to_numpy()
+            outliers = (column_values < q1 - 1.5 * (q3 - q1)) | (column_values > q3 + 1.5 * (q3 - q1))
+            assert np.array_equal(quantiles.filter_mask(column, 'outliers', mask), outliers)
+            within = (column_values >= q1) & (column_values <= q3)
+            assert np.array_equal(quantiles.filter_mask(column, 'within_IQR', mask), within)
+
+
+# Step 1: Load the dataset, encoded with the same schema as the dashboard
+df = ingest.ENCODER.encode_frame(pd.read_csv("data/student_data.csv"))
+
+# Step 2: Quartiles from merged block value counts match pandas
+quantiles = aggregates.BlockQuantiles(df, vaSystem.quantile_columns, block_size=block_size)
+check_quartiles(quantiles, df)
+
+# Step 3: After rows change and new ones are appended, the updated sketches match a fresh scan
+rows = np.concatenate([rng.choice(len(df), 20, replace=False), np.arange(len(df), len(df) + 80)])
+changed = pd.concat([df, df.sample(80, random_state=0)], ignore_index=True)
+for column in ['absences', 'G3']:
+    changed.loc[rows[:20], column] = rng.permutation(changed[column].to_numpy())[:20]
+quantiles.update(changed, rows)
+check_quartiles(quantiles, changed)
+
+print('Block quartiles and quartile filters match pandas')
@@ -0,0 +1,45 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Checks the correlation view's block statistics (see aggregates.CorrelationBlocks) against numpy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import aggregates
+import ingest
+import vaSystem
+
+rng = np.random.default_rng(0)
+block_size = 64  # Small blocks make a selection take whole blocks, add rows and remove rows at once
+
+
+def random_masks(n_rows):
+    # Random selections, from a handful of students to nearly all of them
+    return [rng.random(n_rows) < share for share in (0.01, 0.1, 0.5, 0.9, 0.99)] + [np.ones(n_rows, dtype=bool)]
+
+
+def check_correlation(blocks, df):
+    data = df[vaSystem.correlation_columns].to_numpy(dtype=float)
+    for mask in random_masks(len(df)):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            expected = np.corrcoef(data[mask].T)
+        np.testing.assert_allclose(blocks.correlation(mask), expected, atol=1e-9, equal_nan=True)
+
+
+# Step 1: Load the dataset, encoded with the same schema as the dashboard
+df = ingest.ENCODER.encode_frame(pd.read_csv("data/student_data.csv"))
+
+# Step 2: Correlations from merged block sums and cross products match numpy
+blocks = aggregates.CorrelationBlocks(df, vaSystem.correlation_columns, block_size=block_size)
+check_correlation(blocks, df)
+
+# Step 3: After rows change and new ones are appended, the updated blocks match a fresh scan
+rows = np.concatenate([rng.choice(len(df), 20, replace=False), np.arange(len(df), len(df) + 80)])
+changed = pd.concat([df, df.sample(80, random_state=0)], ignore_index=True)
+for column in ['absences', 'G3', 'goout']:
+    changed.loc[rows[:20], column] = rng.permutation(changed[column].to_numpy())[:20]
+blocks.update(changed, rows)
+check_correlation(blocks, changed)
+
+print('Block correlations match numpy')
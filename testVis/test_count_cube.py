@@ -0,0 +1,42 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Checks the count cube behind the cross-filtered histograms and heatmap (see aggregates.CountCube) against a scan of the rows
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import aggregates
+import ingest
+import selection
+import vaSystem
+
+rng = np.random.default_rng(0)
+
+# Step 1: Load the dataset, encoded with the same schema as the dashboard
+df = ingest.ENCODER.encode_frame(pd.read_csv("data/student_data.csv"))
+
+# Step 2: Build the cube as the dashboard does
+bin_masks = {attribute: selection.BinMasks(df[attribute].to_numpy()) for attribute in ['sex', 'higher', 'Pstatus', 'G3']}
+heatmap_bins = aggregates.BinnedAttributes(df, vaSystem.heatmap_num_bins)
+cube = vaSystem.Dashboard.create_count_cube(bin_masks, heatmap_bins)
+
+# Step 3: Cube cells match the counts of the rows under the same brushes
+for _ in range(50):
+    # Each attribute is left unbrushed or brushed on a random set of its values, possibly none
+    brushes = {attribute: None if rng.random() < 0.4 else rng.random(len(attribute_masks.values)) < 0.5
+               for attribute, attribute_masks in bin_masks.items()}
+    rows = np.ones(len(df), dtype=bool)
+    for attribute, value_mask in brushes.items():
+        if value_mask is not None:
+            rows &= bin_masks[attribute].select_mask(value_mask)
+    assert np.array_equal(cube.heatmap_counts(brushes), heatmap_bins.counts(rows))
+
+    for attribute in bin_masks:
+        others = np.ones(len(df), dtype=bool)
+        for other, value_mask in brushes.items():
+            if other != attribute and value_mask is not None:
+                others &= bin_masks[other].select_mask(value_mask)
+        assert np.array_equal(cube.histogram_counts(attribute, brushes), bin_masks[attribute].counts(others)), attribute
+
+print('Count cube matches a scan of the rows')
@@ -1,24 +1,16 @@
+import os
+import sys
+
 import pandas as pd
 import plotly.express as px
 import seaborn as sns
 import matplotlib.pyplot as plt
 
-# Example: load the dataset (replace with your actual DataFrame)
-df = pd.read_csv("data/student_data.csv")
+# Step 1: Load the dataset, encoded with the same schema as the dashboard (see ingest.py)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ingest
 
-# Step 1: Encode categorical variables to numeric values (if necessary)
-# For binary categorical columns, you can use Label Encoding
-df['sex'] = df['sex'].map({'F': 0, 'M': 1})
-df['school'] = df['school'].map({'GP': 0, 'MS': 1})
-df['address'] = df['address'].map({'U': 0, 'R': 1})
-df['Pstatus'] = df['Pstatus'].map({'T': 0, 'A': 1})
-df['schoolsup'] = df['schoolsup'].map({'yes': 1, 'no': 0})
-df['famsup'] = df['famsup'].map({'yes': 1, 'no': 0})
-df['famsize'] = df['famsize'].map({'GT3': 1, 'LE3': 0})
-df['activities'] = df['activities'].map({'yes': 1, 'no': 0})
-df['higher'] = df['higher'].map({'yes': 1, 'no': 0})
-df['internet'] = df['internet'].map({'yes': 1, 'no': 0})
-df['romantic'] = df['romantic'].map({'yes': 1, 'no': 0})
+df = ingest.ENCODER.encode_frame(pd.read_csv("data/student_data.csv"))
 
 # Step 2: Select relevant numeric and encoded columns
 columns = ['address','Pstatus','famsize', 'age', 'sex', 'studytime', 'failures', 'Pstatus', 'Medu', 'Fedu', 
@@ -0,0 +1,62 @@
+import os
+import sys
+
+import numpy as np
+
+# Checks the t-SNE selection index and the stored selection format (see selection.py) against brute force
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import selection
+
+rng = np.random.default_rng(0)
+
+# Step 1: Random points, clustered like a t-SNE layout, plus a few duplicates and points on one line
+x = np.concatenate([rng.normal(center, 3, 1000) for center in (-20, 0, 25)] + [np.full(50, 5.0)])
+y = np.concatenate([rng.normal(center, 4, 1000) for center in (10, -15, 0)] + [np.linspace(-30, 30, 50)])
+index = selection.GridIndex(x, y)
+
+# Step 2: Box selections, including boxes drawn right to left, past the points and between them
+boxes = [tuple(rng.uniform(-40, 40, 4)) for _ in range(200)] + [(-100, 100, -100, 100), (50, 60, 50, 60), (5, 5, -30, 30)]
+for x0, x1, y0, y1 in boxes:
+    expected = np.flatnonzero((x >= min(x0, x1)) & (x <= max(x0, x1)) & (y >= min(y0, y1)) & (y <= max(y0, y1)))
+    assert np.array_equal(index.box(x0, x1, y0, y1), expected), (x0, x1, y0, y1)
+
+# Step 3: Lasso selections, as random (possibly self-intersecting) polygons
+for _ in range(200):
+    center = rng.uniform(-30, 30, 2)
+    polygon = center + rng.normal(0, 15, (rng.integers(3, 12), 2))
+    expected = np.flatnonzero(selection.points_in_polygon(x, y, polygon))
+    assert np.array_equal(index.lasso(polygon), expected)
+
+# Step 4: Region masks from Dash selectedData match the row lists
+region = {'range': {'x': [-10, 10], 'y': [-20, 5]}}
+mask = index.region_mask(region)
+assert np.array_equal(np.flatnonzero(mask), index.box(-10, 10, -20, 5))
+lasso = {'lassoPoints': {'x': [-30, 0, 10, -5], 'y': [0, 20, -10, -25]}}
+assert np.array_equal(np.flatnonzero(index.region_mask(lasso)), index.lasso(np.column_stack([lasso['lassoPoints']['x'], lasso['lassoPoints']['y']])))
+assert index.region_mask({}) is None
+
+# Step 5: Stored selections decode to the same mask, whether deflated or not, and empty ones stay empty
+n_rows = len(x)
+masks = {
+    'empty': np.zeros(n_rows, dtype=bool),
+    'all': np.ones(n_rows, dtype=bool),
+    'box': mask,
+    'random': rng.random(n_rows) < 0.5,
+    'odd length': rng.random(n_rows - 3) < 0.1,
+}
+for name, mask in masks.items():
+    payload = selection.encode_selection(mask, 'v1')
+    decoded = selection.decode_selection(payload, 'v1')
+    assert decoded is not None and np.array_equal(decoded, mask), name
+    assert payload['count'] == selection.selection_count(payload, 'v1') == np.count_nonzero(mask), name
+assert selection.encode_selection(masks['all'], 'v1')['encoding'] == 'deflate'
+assert selection.encode_selection(masks['random'], 'v1')['encoding'] == 'bits'
+
+# Step 6: A selection made on another dataset version, or no selection, is dropped
+payload = selection.encode_selection(masks['box'], 'v1')
+assert selection.decode_selection(payload, 'v2') is None
+assert selection.selection_count(payload, 'v2') == 0
+assert selection.decode_selection(None, 'v1') is None
+assert np.array_equal(selection.decode_selection(payload), masks['box'])
+
+print('Selection index and stored selections match brute force')
@@ -1,46 +1,26 @@
+import copy
+import glob
+import os
+import threading
+
 import dash
-from dash import dcc, html, Input, Output
+from dash import dcc, html, Input, Output, State, Patch
 import numpy as np
-import pandas as pd
-from sklearn.compose import ColumnTransformer
-from sklearn.decomposition import PCA
-from sklearn.manifold import TSNE
-from sklearn.preprocessing import KBinsDiscretizer, StandardScaler
-import plotly.express as px
 import plotly.graph_objects as go
-from plotly.subplots import make_subplots  # Import make_subplots
-
-# Load and preprocess the data
-df = pd.read_csv('data/student_data.csv')
-
-## Preprocessing data.
-df = pd.get_dummies(df, columns=['Mjob', 'Fjob', 'reason', 'guardian'], drop_first=True)
-
-df['sex'] = df['sex'].map({'F': 0, 'M': 1})
-df['school'] = df['school'].map({'GP': 0, 'MS': 1})
-df['address'] = df['address'].map({'U': 0, 'R': 1})
-df['Pstatus'] = df['Pstatus'].map({'T': 0, 'A': 1})
-df['famsup'] = df['famsup'].map({'yes': 1, 'no': 0})
-df['schoolsup'] = df['schoolsup'].map({'yes': 1, 'no': 0})
-df['famsize'] = df['famsize'].map({'GT3': 1, 'LE3': 0})
-df['activities'] = df['activities'].map({'yes': 1, 'no': 0})
-df['paid'] = df['paid'].map({'yes': 1, 'no': 0})
-df['higher'] = df['higher'].map({'yes': 1, 'no': 0})
-df['nursery'] = df['nursery'].map({'yes': 1, 'no': 0})
-df['internet'] = df['internet'].map({'yes': 1, 'no': 0})
-df['romantic'] = df['romantic'].map({'yes': 1, 'no': 0})
-
-boolean_columns = [
-    'Mjob_health', 'Mjob_other', 'Mjob_services', 'Mjob_teacher',
-    'Fjob_health', 'Fjob_other', 'Fjob_services', 'Fjob_teacher',
-    'reason_home', 'reason_other', 'reason_reputation',
-    'guardian_mother', 'guardian_other'
-]
 
-df[boolean_columns] = df[boolean_columns].astype(int)
+import aggregates
+import embedding
+import ingest
+import memo
+import metrics
+import selection
+import sweep
 
-##numeric_columns = df.iloc[:, [0, 1, 2, 3, 4, 5, 6, 7, 12, 13, 14,15,16,17, 18,19,20,21,22,23, 24, 25, 26, 27, 28, 29, 30,31,32]]
-numeric_columns = df.select_dtypes(include=['number'])
+DATA_PATH = os.environ.get('VA_DATA_PATH', 'data/student_data.csv')
+# Glob pattern of several data files served side by side, e.g. 'data/cohorts/*.csv'
+DATASETS_PATTERN = os.environ.get('VA_DATASETS')
+# Datasets are loaded on first use and the least recently used are dropped above this total size
+MEMORY_BUDGET_BYTES = int(os.environ.get('VA_MEMORY_BUDGET_MB', 2048)) * 2**20
 
 
 '''
@@ -117,86 +97,25 @@ def explain_attribute(attribute, bin_value):
 histogramWidth = 240
 histogramHeight = 400
 histogramTitleFontSize = 16
-data_standardized = StandardScaler().fit_transform(numeric_columns)
-
-pca = PCA(n_components=5)
-df_pca = pca.fit_transform(data_standardized)
-
-tsne = TSNE(n_components=2, perplexity=15, learning_rate=200, random_state=42)
-tsne_results = tsne.fit_transform(df_pca)
-
-df['tsne-1'] = tsne_results[:, 0]
-df['tsne-2'] = tsne_results[:, 1]
-
-x_margin = (df['tsne-1'].max() - df['tsne-1'].min()) * 0.1
-y_margin = (df['tsne-2'].max() - df['tsne-2'].min()) * 0.1
-
-x_min, x_max = df['tsne-1'].min() - x_margin, df['tsne-1'].max() + x_margin
-y_min, y_max = df['tsne-2'].min() - y_margin, df['tsne-2'].max() + y_margin
-
-app = dash.Dash(__name__)
-
-@app.callback(
-    Output('tsne-plot', 'figure'),
-    [Input('gender-histogram', 'selectedData'),
-     Input('wants-higher-histogram', 'selectedData'),
-     Input('parents-together-histogram', 'selectedData'),
-    Input('grade-histogram', 'selectedData')
-    ]
-)
-def update_tsne_plot(studytime_selected, wants_higher_selected, parents_together_selected, grade_selected):    
-    selected_indices = set(range(len(df)))
-
-    if studytime_selected and 'points' in studytime_selected:
-        studytime_indices = set()
-        for point in studytime_selected['points']:
-            studytime_indices.update(point['pointNumbers']) 
-        selected_indices.intersection_update(studytime_indices)
-
-    if wants_higher_selected and 'points' in wants_higher_selected:
-        higher_indices = set()
-        for point in wants_higher_selected['points']:
-            higher_indices.update(point['pointNumbers'])  
-        selected_indices.intersection_update(higher_indices)
-
-    if parents_together_selected and 'points' in parents_together_selected:
-        parents_together_indices = set()
-        for point in parents_together_selected['points']:
-            parents_together_indices.update(point['pointNumbers'])  
-        selected_indices.intersection_update(parents_together_indices)
-
-    if grade_selected and 'points' in grade_selected:
-        grades_indices = set()
-        for point in grade_selected['points']:
-            grades_indices.update(point['pointNumbers'])  
-        selected_indices.intersection_update(grades_indices)
-
-    if(len(selected_indices) != 0):
-        df['highlight'] = 0.2 
-
-    df.loc[list(selected_indices), 'highlight'] = 1  # Set opacity to fully visible for selected points
-
-    # Create the scatter plot
-    fig = px.scatter(
-        df, x='tsne-1', y='tsne-2', color='G3',
-        opacity=df['highlight'],  # Use the 'highlight' column for opacity
-        title="t-SNE Visualization",
-        labels={'G3': 'Final Grade', 'G1': 'First Period Grade', 'G2': 'Second Period Grade'},
-        hover_data={'tsne-1': False, 'tsne-2': False, 
-                    'age': True, 'G1': True, 'G2': True},  
-        color_continuous_scale='Viridis',  
-        range_color=[0, 20]  
-    )
-
-    fig.update_layout(
-        height=600,
-        width=800,
-        dragmode='select',  # Set default to box select tool
-        title="Filtered t-SNE Visualization"
-    )
-    
-    return fig
 
+EMBEDDING_POLL_MS = 1000
+
+# Watch the data file and apply new or changed rows while serving, e.g. grades added during the term
+WATCH_DATA = os.environ.get('VA_WATCH_DATA', '0') == '1'
+DATA_POLL_MS = int(os.environ.get('VA_DATA_POLL_MS', 5000))
+# t-SNE is refitted once more than this share of the students were placed by projection since the last fit
+REFIT_DRIFT = float(os.environ.get('VA_REFIT_DRIFT', 0.1))
+
+# Rendering of the t-SNE view for large datasets
+TSNE_WEBGL_THRESHOLD = int(os.environ.get('VA_TSNE_WEBGL_THRESHOLD', 10000))  # Above this many students the scatter is drawn with WebGL
+TSNE_DENSITY_THRESHOLD = int(os.environ.get('VA_TSNE_DENSITY_THRESHOLD', 200000))  # Above this many students the view becomes a density raster
+TSNE_POINT_LIMIT = int(os.environ.get('VA_TSNE_POINT_LIMIT', 20000))  # In density mode, a zoomed region with fewer students shows them individually
+TSNE_DENSITY_BINS = int(os.environ.get('VA_TSNE_DENSITY_BINS', 200))  # Raster cells per axis in density mode
+
+# Value of the embedding picker for the dashboard's own embedding, next to the keys of swept ones
+DEFAULT_EMBEDDING = 'default'
+
+VIEW_CACHE_MAX_BYTES = int(os.environ.get('VA_VIEW_CACHE_MB', 256)) * 2**20
 
 categories = ['Mother Education (Medu)', 
               'Father Education (Fedu)', 
@@ -207,306 +126,994 @@ categories = ['Mother Education (Medu)',
               "Workday Alcohol Consuption",
               ]
 
-@app.callback(
-    Output('heatmap', 'figure'),
-    [Input('selected-points', 'data'),
-    Input('grade-histogram', 'selectedData')
-     ]
-)
-def create_heatmap(selected_points, grade_points):
-    selected_df = df  # Show full dataset if no points are selected
-
-    if grade_points and grade_points['points']:
-        l = list()
-        for points in grade_points['points']:
-            for p in points['pointNumbers']:
-                l.append(p)
-
-        selected_df = df.iloc[l]
-    if selected_points:
-        selected_df = df.iloc[selected_points]
-
-    attributes = ['Medu', 'Fedu', 'failures', 'studytime', 'traveltime', 'Walc', 'Dalc', 'health', 'famrel', 'goout', 'freetime']
-    
-    custom_titles = {
-        'Medu': 'Mother Education Level',
-        'Fedu': 'Father Education Level',
-        'failures': 'Number of Failures',
-        'studytime': 'Weekly Study Time',
-        'traveltime': 'Travel Time to School',
-        'Walc': 'Weekend Alcohol Consumption',
-        'Dalc': 'Workday Alcohol Consumption',
-        'health': 'Quality of health',
-        'famrel': 'Quality of Family Relationships',
-        'goout': 'Going Out with Friends',
-        'freetime': 'Freetime after school'
-    }
-    
-    num_bins = {
-        'Medu': 5, 'Fedu': 5, 'failures': 4, 'studytime': 4, 'traveltime': 4,
-        'Walc': 5, 'Dalc': 5, 'health': 5, 'famrel': 5, 'goout': 5, 'freetime': 5
-    }
-    
-    heatmap_data = pd.DataFrame(columns=attributes, index=[0, 1, 2, 3, 4])  
-    text_data = pd.DataFrame(columns=attributes, index=[0, 1, 2, 3, 4])  
-    hover_text = pd.DataFrame(columns=attributes, index=[0, 1, 2, 3, 4])  
-
-    for attribute in attributes:
-        bins = num_bins[attribute]
-        discretizer = KBinsDiscretizer(n_bins=bins, encode='ordinal', strategy='uniform')
-
-        try:
-            binned_data = discretizer.fit_transform(selected_df[[attribute]])
-        except ValueError:
-            binned_data = np.zeros((selected_df.shape[0], 1))
-
-        bin_counts = pd.Series(binned_data.flatten()).value_counts().sort_index()
-        bin_counts = bin_counts.reindex(range(bins)).fillna(0).astype(int)
-        total_count = bin_counts.sum()
-        if total_count > 0:
-            bin_counts_normalized = bin_counts / total_count
-        else:
-            bin_counts_normalized = bin_counts  
+heatmap_titles = {
+    'Medu': 'Mother Education Level',
+    'Fedu': 'Father Education Level',
+    'failures': 'Number of Failures',
+    'studytime': 'Weekly Study Time',
+    'traveltime': 'Travel Time to School',
+    'Walc': 'Weekend Alcohol Consumption',
+    'Dalc': 'Workday Alcohol Consumption',
+    'health': 'Quality of health',
+    'famrel': 'Quality of Family Relationships',
+    'goout': 'Going Out with Friends',
+    'freetime': 'Freetime after school'
+}
+
+heatmap_num_bins = {
+    'Medu': 5, 'Fedu': 5, 'failures': 4, 'studytime': 4, 'traveltime': 4,
+    'Walc': 5, 'Dalc': 5, 'health': 5, 'famrel': 5, 'goout': 5, 'freetime': 5
+}
+
+# Columns of the correlation view, as in testVis/test_heatmap.py
+correlation_columns = ['address', 'Pstatus', 'famsize', 'age', 'sex', 'studytime', 'failures', 'Medu', 'Fedu',
+                       'schoolsup', 'famsup', 'activities', 'higher', 'internet', 'romantic',
+                       'famrel', 'freetime', 'goout', 'Dalc', 'Walc', 'health', 'absences', 'G3']
+
+# Axes of the parallel-coordinates view, as in testVis/test_parallel_coordinates.py
+parcoords_labels = {
+    'studytime': "Study Time",
+    'famsup': "Family Support",
+    'internet': "Internet Access",
+    'failures': "Past Failures",
+    'romantic': "Romantic Relationship",
+    'famrel': "Family Relationship",
+    'freetime': "Free Time",
+    'goout': "Going Out",
+    'Dalc': "Workday Alcohol Consumption",
+    'absences': "Absences",
+    'traveltime': "Travel Time",
+    'G3': "Final Grade",
+}
+PARCOORDS_LINE_LIMIT = 2000  # Up to this many selected students every student is drawn as a line
+PARCOORDS_SAMPLE = 500  # Above it, bands between axis bins and a sample of this many lines
+PARCOORDS_BAND_LEVELS = 5
+
+# Columns of the quartile filters and the filters offered, as in testVis/test_boxplots.py
+quantile_columns = {'G1': 'First Period Grade', 'G2': 'Second Period Grade', 'G3': 'Final Grade', 'absences': 'Absences'}
+quantile_filters = {
+    'outliers': 'Outliers',
+    'lower_25': 'Lower 25%',
+    'lower_middle': 'Lower Middle 50%',
+    'upper_middle': 'Upper Middle 50%',
+    'upper_25': 'Upper 25%',
+    'within_IQR': 'Within IQR',
+}
+
+heatmap_bin_labels = [
+    [explain_attribute(attribute, bin_idx) if bin_idx < bins else None for bin_idx in range(max(heatmap_num_bins.values()))]
+    for attribute, bins in heatmap_num_bins.items()
+]
+
 
-        heatmap_data.loc[0:bins - 1, attribute] = bin_counts_normalized
-        text_data.loc[0:bins - 1, attribute] = bin_counts_normalized.apply(lambda x: f"{x:.1f}")
-        hover_text.loc[0:bins - 1, attribute] = [
-            f"{explain_attribute(attribute, bin_idx)}: {float(distr) * 100:.1f}% of students"
-            for bin_idx, distr in enumerate(bin_counts_normalized)
+class Dashboard:
+    # Everything the dashboard derives from one data file. The encoded data and the embedding
+    # are memory-mapped from the cache directory, so server processes serving the same file
+    # share them read-only through the page cache. Callbacks never modify this state; a data
+    # change builds the new state aside and publishes it while no callback is reading.
+
+    def __init__(self, data_path=DATA_PATH, watch=WATCH_DATA):
+        self.data_path = data_path
+        self.base = self  # Embedding views from for_embedding are copies; data changes go to the dashboard they came from
+        self.data_watch = ingest.DeltaReader(data_path) if watch else None
+        self._reload_lock = threading.Lock()
+        self._state_lock = memo.ReadWriteLock()  # Read by every callback (see dispatch), written when a data change is published
+
+        # Load the data, encoded with an explicit schema and cached column by column on disk
+        with metrics.phase('data_load'):
+            self.df = ingest.load_encoded(data_path)
+        self.numeric_columns = self.df.select_dtypes(include=['number'])
+
+        # Scaling, PCA and t-SNE are cached on disk, keyed by the data file and the parameters in embedding.py.
+        # Without a cached embedding, t-SNE runs in the background and the plot starts from the first two PCA components.
+        self.embedding_job = embedding.EmbeddingJob(data_path, self.numeric_columns)
+        self._tsne_index = (None, None)
+        self.embedding_name = DEFAULT_EMBEDDING
+        self._embedding_views = {}
+
+        # Derived views are cached per selection; the dataset version drops them when the data changes
+        self.dataset_version = embedding.file_digest(data_path)[:16]
+        self.view_cache = memo.ViewCache(VIEW_CACHE_MAX_BYTES, self.dataset_version)
+
+        # Row masks per histogram bar, used to resolve histogram brushes without touching df
+        self.bin_masks = {attribute: selection.BinMasks(self.df[attribute].to_numpy()) for attribute in ['sex', 'higher', 'Pstatus', 'G3']}
+
+        # Bins are fixed over the full dataset, so every selection is compared on the same bins
+        self.heatmap_bins = aggregates.BinnedAttributes(self.df, heatmap_num_bins)
+
+        # Counts over every combination of histogram bars and heatmap bins, so brushes never scan rows
+        self.count_cube = self.create_count_cube(self.bin_masks, self.heatmap_bins)
+
+        # Per-block sums and cross products, combined into the correlations of any selection
+        self.correlation_blocks = aggregates.CorrelationBlocks(self.df, correlation_columns)
+
+        # Bin codes of the parallel-coordinates axes, for its bands, line sample and brushes
+        self.axis_bins = aggregates.AxisBins(self.df, parcoords_labels)
+
+        # Per-block value counts of the grade columns, merged into the quartiles of any selection
+        self.quantiles = aggregates.BlockQuantiles(self.df, quantile_columns)
+
+        self.histogram_figures = self.create_histogram_figures()
+
+    def reload_data(self):
+        # Rows were removed or the columns changed, so everything is loaded again as at startup
+        fresh = vars(Dashboard(self.data_path, watch=False))
+        fresh.update(base=self, data_watch=self.data_watch, _reload_lock=self._reload_lock, _state_lock=self._state_lock)
+        self.publish(fresh)
+
+    def publish(self, fresh):
+        # Swaps in a fully built state at once, so a callback sees either the old data or the new
+        with self._state_lock.write():
+            self.__dict__.update(fresh)
+            self.view_cache.set_version(self.dataset_version)
+
+    def apply_delta(self, rows, encoded):
+        # Only the changed and appended rows are encoded (see ingest.DeltaReader). The masks and
+        # bin codes are updated for those rows, and the rows are projected into the current
+        # embedding until the drift passes REFIT_DRIFT. A new dataset version drops the cached
+        # views and the selections made on the old data.
+        df = ingest.apply_delta(self.df, rows, encoded)
+        numeric_columns = df.select_dtypes(include=['number'])
+        # Everything is updated on copies and published together, since callbacks keep reading the old state meanwhile
+        bin_masks = {attribute: copy.copy(masks) for attribute, masks in self.bin_masks.items()}
+        for attribute, masks in bin_masks.items():
+            masks.update(df[attribute].to_numpy(), rows)
+        heatmap_bins = copy.copy(self.heatmap_bins)
+        heatmap_bins.update(df, rows)
+        correlation_blocks = copy.copy(self.correlation_blocks)
+        correlation_blocks.update(df, rows)
+        quantiles = copy.copy(self.quantiles)
+        quantiles.update(df, rows)
+
+        if self.embedding_job.done:
+            embedding_job = embedding.UpdatedEmbedding(self.embedding_job, self.data_path, numeric_columns, rows, REFIT_DRIFT)
+        else:
+            # The layout is still being fitted on the old rows, so fit again on the new ones
+            embedding_job = embedding.EmbeddingJob(self.data_path, numeric_columns)
+            embedding_job.version = self.embedding_job.version + 1
+
+        # Rebuilt rather than updated, since new values or ranges change its shape and it is one pass over the codes
+        count_cube = self.create_count_cube(bin_masks, heatmap_bins)
+
+        staged = copy.copy(self)
+        staged.df, staged.numeric_columns, staged.bin_masks, staged.heatmap_bins = df, numeric_columns, bin_masks, heatmap_bins
+        staged.count_cube, staged.correlation_blocks, staged.quantiles = count_cube, correlation_blocks, quantiles
+        staged.axis_bins = aggregates.AxisBins(df, parcoords_labels)
+        staged.embedding_job, staged._tsne_index, staged._embedding_views = embedding_job, (None, None), {}
+        staged.histogram_figures = staged.create_histogram_figures()
+        staged.dataset_version = self.data_watch.version
+        self.publish(vars(staged))
+
+    def check_data(self):
+        # True when the data file changed and the dataset was updated
+        if self.data_watch is None or not self.data_watch.changed():
+            return False
+        with self._reload_lock:
+            if not self.data_watch.changed():
+                return False  # Applied by a concurrent poll
+            with metrics.phase('data_update'):
+                delta = self.data_watch.read_delta()
+                if delta is None:
+                    self.reload_data()
+                elif len(delta[0]):
+                    self.apply_delta(*delta)
+                else:
+                    return False
+        return True
+
+    def memory_bytes(self):
+        # Approximate memory held by this dataset: its (memory-mapped) data and embedding, the
+        # masks derived from them and the cached views
+        arrays = [self.df[column].to_numpy() for column in self.df.columns] + [self.heatmap_bins.codes]
+        for view in [self, *self._embedding_views.values()]:
+            arrays += list(view.embedding_job.arrays.values()) + [view.embedding_job.layout]
+            if view._tsne_index[1] is not None:
+                index = view._tsne_index[1]
+                arrays += [index.order, index.cell_start, index.sorted_x, index.sorted_y]
+        arrays += [array for bin_masks in self.bin_masks.values() for array in (bin_masks.masks, bin_masks.codes)]
+        return (sum(np.asarray(array).nbytes for array in arrays) + self.count_cube.nbytes + self.correlation_blocks.nbytes
+                + self.axis_bins.nbytes + self.quantiles.nbytes + self.view_cache.size)
+
+    @staticmethod
+    def create_count_cube(bin_masks, heatmap_bins):
+        return aggregates.CountCube({attribute: (masks.codes, len(masks.values)) for attribute, masks in bin_masks.items()},
+                                    heatmap_bins)
+
+    def for_embedding(self, name):
+        # The same dataset shown with one of the embeddings from a parameter sweep (see sweep.py).
+        # It shares the data, masks and view cache, only the layout and its index are its own.
+        if not name or name == self.embedding_name:
+            return self
+        view = self._embedding_views.get(name)
+        if view is None:
+            if name not in {result['key'] for result in sweep.load_results(self.data_path)}:
+                return self
+            arrays = embedding.load_embedding(name)
+            if arrays is None:
+                return self
+            view = copy.copy(self)
+            view.embedding_name = name
+            view.embedding_job = embedding.StoredEmbedding(name, arrays)
+            view._tsne_index = (None, None)
+            self._embedding_views[name] = view
+        return view
+
+    def embedding_token(self):
+        # Changes whenever the layout on screen should change: another embedding picked, or a new layout published
+        return [self.embedding_name, self.embedding_job.version]
+
+    def embedding_options(self):
+        options = [{'label': 'Default embedding', 'value': DEFAULT_EMBEDDING}]
+        for result in sweep.load_results(self.data_path):
+            options.append({
+                'label': f"PCA {result['pca_params']['n_components']}, perplexity {result['tsne_params']['perplexity']}, "
+                         f"learning rate {result['tsne_params']['learning_rate']}: trustworthiness {result['trustworthiness']:.3f}, "
+                         f"kNN G3 error {result['knn_g3_mae']:.2f}",
+                'value': result['key'],
+            })
+        return options
+
+    def tsne_index(self):
+        # Spatial index over the current t-SNE layout, rebuilt when the background job publishes a new one
+        version, index = self._tsne_index
+        if version != self.embedding_job.version or index is None:
+            layout = self.embedding_job.layout
+            index = selection.GridIndex(layout[:, 0], layout[:, 1])
+            self._tsne_index = (self.embedding_job.version, index)
+        return index
+
+    def histogram_brushes(self, gender_selected, wants_higher_selected, parents_together_selected, grade_selected):
+        # The bars brushed on each histogram as a mask over its values, None where nothing is brushed
+        return {attribute: self.bin_masks[attribute].value_mask(selection.selected_bin_values(selected_data))
+                for attribute, selected_data in [('sex', gender_selected), ('higher', wants_higher_selected),
+                                                 ('Pstatus', parents_together_selected), ('G3', grade_selected)]}
+
+    def brushed_rows(self, rows, brushes, skip=None):
+        # Row scan for t-SNE selections, which the count cube cannot answer: the selected rows
+        # that are also under the histogram brushes
+        for attribute, value_mask in brushes.items():
+            if value_mask is not None and attribute != skip:
+                rows = rows & self.bin_masks[attribute].select_mask(value_mask)
+        return rows
+
+    def selection_rows(self, selected_points, brushes):
+        # The shared selection: the stored t-SNE or parallel-coordinates selection under the histogram brushes
+        rows = selection.decode_selection(selected_points, self.dataset_version)
+        if rows is None and all(value_mask is None for value_mask in brushes.values()):
+            return None
+        return self.brushed_rows(np.ones(len(self.df), dtype=bool) if rows is None else rows, brushes)
+
+    @staticmethod
+    def brushes_key(brushes):
+        return {attribute: None if value_mask is None else np.flatnonzero(value_mask).tolist()
+                for attribute, value_mask in brushes.items()}
+
+    def cohort_rows(self, filters):
+        # Row mask of a cohort given as filters on the CSV columns, see ingest.Encoder.rows_where
+        return ingest.ENCODER.rows_where(self.df, filters)
+
+    def tsne_selection(self, selected_points, gender_selected, wants_higher_selected, parents_together_selected, grade_selected):
+        # The shared selection, whichever view made it, as a mask over every student
+        brushes = self.histogram_brushes(gender_selected, wants_higher_selected, parents_together_selected, grade_selected)
+        rows = self.selection_rows(selected_points, brushes)
+        return np.ones(len(self.df), dtype=bool) if rows is None else rows
+
+    @staticmethod
+    def tsne_opacity(selected):
+        if selected.all():
+            return 1.0
+        return np.where(selected, 1.0, 0.2)  # Fully visible for selected points, dimmed otherwise
+
+    def tsne_render_mode(self):
+        if len(self.df) > TSNE_DENSITY_THRESHOLD:
+            return 'density'
+        if len(self.df) > TSNE_WEBGL_THRESHOLD:
+            return 'webgl'
+        return 'svg'
+
+    def create_tsne_density_figure(self, selected, view):
+        df = self.df
+        layout = self.embedding_job.layout
+        x, y = layout[:, 0], layout[:, 1]
+        if view is None:
+            view = [[float(x.min()), float(x.max())], [float(y.min()), float(y.max())]]
+        (x0, x1), (y0, y1) = view
+        in_view = self.tsne_index().box(x0, x1, y0, y1)
+
+        # Zoomed in far enough: draw the individual students in the visible region
+        if len(in_view) <= TSNE_POINT_LIMIT:
+            rows = in_view
+            return go.Figure(go.Scattergl(
+                x=x[rows], y=y[rows], mode='markers',
+                marker=dict(color=df['G3'].to_numpy()[rows], colorscale='Viridis', cmin=0, cmax=20,
+                            colorbar=dict(title='Final Grade'), opacity=self.tsne_opacity(selected[rows])),
+                customdata=df[['age', 'G1', 'G2']].to_numpy()[rows],
+                hovertemplate='age=%{customdata[0]}<br>First Period Grade=%{customdata[1]}<br>'
+                              'Second Period Grade=%{customdata[2]}<br>Final Grade=%{marker.color}<extra></extra>',
+            ))
+
+        # Otherwise a raster of the selected students in view, colored by their mean final grade
+        rows = in_view[selected[in_view]]
+        x_centers, y_centers, counts, sums = aggregates.density_grid(
+            x[rows], y[rows], df['G3'].to_numpy()[rows], (x0, x1), (y0, y1), TSNE_DENSITY_BINS)
+        mean_grade = np.round(np.divide(sums, counts, out=np.full(counts.shape, np.nan), where=counts > 0), 1)
+        counts = counts.astype(np.int64)
+
+        fig = go.Figure(go.Heatmap(
+            x=x_centers, y=y_centers, z=mean_grade, customdata=counts,
+            colorscale='Viridis', zmin=0, zmax=20,
+            colorbar=dict(title='Final Grade'),
+            hovertemplate='Mean final grade: %{z:.1f}<br>Students: %{customdata}<extra></extra>',
+        ))
+        # Invisible markers on the occupied cells make box and lasso selection available on the raster
+        cell_y, cell_x = np.nonzero(counts)
+        fig.add_trace(go.Scattergl(
+            x=x_centers[cell_x], y=y_centers[cell_y], mode='markers',
+            marker=dict(size=2, opacity=0), hoverinfo='skip', showlegend=False,
+        ))
+        return fig
+
+    def create_tsne_figure(self, selected, view=None):
+        render_mode = self.tsne_render_mode()
+        if render_mode == 'density':
+            fig = self.create_tsne_density_figure(selected, view)
+        else:
+            import plotly.express as px  # Only needed once a page is served, not at startup
+
+            layout = self.embedding_job.layout
+            plot_df = self.df[['G3', 'age', 'G1', 'G2']].assign(**{'tsne-1': layout[:, 0], 'tsne-2': layout[:, 1]})
+
+            # Create the scatter plot
+            fig = px.scatter(
+                plot_df, x='tsne-1', y='tsne-2', color='G3',
+                title="t-SNE Visualization",
+                labels={'G3': 'Final Grade', 'G1': 'First Period Grade', 'G2': 'Second Period Grade'},
+                hover_data={'tsne-1': False, 'tsne-2': False, 
+                            'age': True, 'G1': True, 'G2': True},  
+                color_continuous_scale='Viridis',  
+                range_color=[0, 20],
+                render_mode=render_mode
+            )
+            fig.update_traces(marker_opacity=self.tsne_opacity(selected))
+
+        fig.update_layout(
+            height=600,
+            width=800,
+            dragmode='select',  # Set default to box select tool
+            title=self.tsne_title(),
+            uirevision='tsne-plot'  # Keep the user's zoom when the figure is replaced
+        )
+        
+        return fig
+
+    def tsne_title(self):
+        if self.embedding_job.done:
+            return "Filtered t-SNE Visualization"
+        if self.embedding_job.error is not None:
+            return f"Filtered t-SNE Visualization (PCA layout, t-SNE failed: {self.embedding_job.error})"
+        return "Filtered t-SNE Visualization (refining...)"
+
+    # The full scatter (coordinates, colors, hover data) is only sent with the page and when the
+    # embedding changes. Brushes and selections made in any view only patch the marker opacity of
+    # the existing figure, except in density mode where the raster has to be recomputed.
+    def update_tsne_plot(self, selected_points, gender_selected, wants_higher_selected, parents_together_selected, grade_selected, view=None):
+        selected = self.tsne_selection(selected_points, gender_selected, wants_higher_selected, parents_together_selected, grade_selected)
+        selected_key = memo.selection_key(len(self.df), selected)
+        if self.tsne_render_mode() == 'density':
+            return self.view_cache.get_or_compute(['tsne', self.embedding_token(), selected_key, view],
+                                                  lambda: self.create_tsne_figure(selected, view))
+
+        def create_patch():
+            patched_fig = Patch()
+            patched_fig['data'][0]['marker']['opacity'] = self.tsne_opacity(selected)
+            # The opacity shows the selection. plotly's own box or lasso highlight is cleared, since it
+            # goes stale once the parallel coordinates or a quartile filter change the selection.
+            patched_fig['data'][0]['selectedpoints'] = None
+            patched_fig['layout']['selections'] = []
+            return patched_fig
+
+        return self.view_cache.get_or_compute(['tsne-opacity', selected_key], create_patch)
+
+    def refresh_tsne_plot(self, embedding_version, view, selected_points, gender_selected, wants_higher_selected, parents_together_selected, grade_selected):
+        selected = self.tsne_selection(selected_points, gender_selected, wants_higher_selected, parents_together_selected, grade_selected)
+        return self.view_cache.get_or_compute(['tsne', self.embedding_token(), memo.selection_key(len(self.df), selected), view],
+                                              lambda: self.create_tsne_figure(selected, view))
+
+    def update_tsne_view(self, relayout_data, view):
+        # Only the density mode renders differently depending on the visible region
+        if self.tsne_render_mode() != 'density' or not relayout_data:
+            return dash.no_update
+        if relayout_data.get('xaxis.autorange') or relayout_data.get('yaxis.autorange'):
+            return None
+
+        x_range = relayout_data.get('xaxis.range') or [relayout_data.get('xaxis.range[0]'), relayout_data.get('xaxis.range[1]')]
+        y_range = relayout_data.get('yaxis.range') or [relayout_data.get('yaxis.range[0]'), relayout_data.get('yaxis.range[1]')]
+        if None in x_range and None in y_range:
+            return dash.no_update
+
+        layout = self.embedding_job.layout
+        current = view or [[float(layout[:, 0].min()), float(layout[:, 0].max())],
+                           [float(layout[:, 1].min()), float(layout[:, 1].max())]]
+        return [x_range if None not in x_range else current[0],
+                y_range if None not in y_range else current[1]]
+
+    def poll_embedding(self, n_intervals, embedding_version):
+        # Only push a new version when the background t-SNE has published a new layout
+        self.embedding_job.poll()
+        if self.embedding_token() == embedding_version:
+            return dash.no_update, self.embedding_job.done
+        return self.embedding_token(), self.embedding_job.done
+
+    def poll_data(self, n_intervals, dataset_version):
+        # The data file was checked before this callback started (see dispatch). An open page then
+        # goes back to its default embedding, since the swept embeddings were fitted on the old data.
+        dashboard = self.base
+        if dashboard.dataset_version == dataset_version:
+            return (dash.no_update,) * 10
+        figures = dashboard.histogram_figures
+        return (dashboard.dataset_version, figures['sex'], figures['higher'], figures['Pstatus'], figures['G3'],
+                dashboard.embedding_options(), DEFAULT_EMBEDDING, dashboard.embedding_token(), dashboard.embedding_job.done, None)
+
+    def select_embedding(self, embedding_name):
+        # The new layout is drawn by refresh_tsne_plot; zoom and t-SNE selection refer to the old coordinates
+        return self.embedding_token(), self.embedding_job.done, None, None
+
+    def create_heatmap(self, selected_points, gender_selected, wants_higher_selected, parents_together_selected, grade_selected):
+        # Histogram brushes alone are summed from the count cube; a t-SNE selection needs a row scan
+        brushes = self.histogram_brushes(gender_selected, wants_higher_selected, parents_together_selected, grade_selected)
+        selected_rows = selection.decode_selection(selected_points, self.dataset_version)
+        if selected_rows is None:
+            return self.view_cache.get_or_compute(['heatmap', self.brushes_key(brushes)],
+                                                  lambda: self.create_heatmap_figure(self.count_cube.heatmap_counts(brushes)))
+
+        rows = self.brushed_rows(selected_rows, brushes)
+        return self.view_cache.get_or_compute(['heatmap', memo.selection_key(len(self.df), rows)],
+                                              lambda: self.create_heatmap_figure(self.heatmap_bins.counts(rows)))
+
+    def create_heatmap_figure(self, counts):
+        distribution = aggregates.distribution(counts)
+
+        hover_text = [
+            [f"{label}: {distr * 100:.1f}% of students" if label is not None else None
+             for label, distr in zip(labels, row)]
+            for labels, row in zip(heatmap_bin_labels, distribution)
         ]
 
-    heatmap_data.fillna(0, inplace=True)
-
-    fig = go.Figure(go.Heatmap(
-        z=heatmap_data.T.values, 
-        x=heatmap_data.index,  
-        y=[custom_titles[attr] for attr in heatmap_data.columns], 
-        colorscale='Inferno',  
-        zmin=0, 
-        zmax=1,  
-        colorbar=dict(title='Relative Distribution'),
-        showscale=True,
-
-        texttemplate='%{text}',  
-        hoverinfo='text',  
-        hovertext=hover_text.T.values,  
-    ))
-
-    fig.update_layout(
-        title="Heatmap of Students' Attribute Bins (Normalized to Max 1)",
-        xaxis_title="Attribute Bins (0-4)",
-        yaxis_title="",
-        height=600,
-        width=800,
-    )
-
-    return fig
-
-
-# App layout
-##  ------------------------------------------------------------------------------
-
-app.layout = html.Div([
-    html.H1("Interactive t-SNE Visualization"),
-    html.Div([
-        dcc.Graph(id='gender-histogram', style={'height': '150px', 'width': '240px'}),
-        dcc.Graph(id='wants-higher-histogram', style={'height': '150px', 'width': '240px'}),
-        dcc.Graph(id='parents-together-histogram', style={'height': '150px', 'width': '240px'}),
-        dcc.Graph(id='grade-histogram', style={'height': '150px', 'width': '540px'}),
-    ], style={'display': 'flex', 'flex-direction': 'row', 'height': '350px'}),
-    html.Div([
-        dcc.Graph(id='tsne-plot', 
-                    figure=update_tsne_plot([], [], [], []), 
-                    style={'height': '600px', 'width': '800px'},
-                    config={'displayModeBar': True},  
-                  ),
-        dcc.Graph(id='heatmap', style={'height': '600px', 'width': '600px'}), 
-    ], style={'display': 'flex', 'flex-direction': 'row'}),
-    dcc.Store(id='selected-points', data=[]),  
-    html.Div(id='selection-output'), 
-])
-
-##  ------------------------------------------------------------------------------
-
-@app.callback(
-    Output('selected-points', 'data'),
-    [Input('tsne-plot', 'selectedData'),
-     ]
-)
-def store_selected_points(selected_data):
-
-    if selected_data:
-        selected_points = [point['pointIndex'] for point in selected_data['points']]
-        return selected_points
-    
-    return []
-    
-
-@app.callback(
-    Output('selection-output', 'children'),
-    Input('selected-points', 'data')
-)
-def display_selected_points(selected_points):
-    if selected_points:
-        return f"Selected Points: {len(selected_points)} ({100 * (len(selected_points) / len(numeric_columns)):.2f}%)"
-    return "No points selected."
-
-
-@app.callback(
-    Output('wants-higher-histogram', 'figure'),
-    Input('selected-points', 'data')
-)
-
-def update_higher_histogram(selected_points):
-    if selected_points:
-        selected_df = df.iloc[selected_points]
-    else:
-        selected_df = df
-
-    wants_higer_fig = px.histogram(
-        selected_df,
-        x='higher',
-        title="Wants higher education",
-        labels={'higher': 'Wants'},
-    )
-
-    wants_higer_fig.update_layout(
-        height=histogramHeight,
-        width=histogramWidth,
-        title_x=0.5,
-        xaxis=dict(
-            title = "",
-            tickvals=[0, 1],
-            ticktext=["No", "Yes"],
-        ),
-        yaxis=dict(
-            title="",
-        ),
-        dragmode='select'
-    )
-
-    wants_higer_fig.update_traces(
-        marker=dict(color='blue')
-    )
-
-    return wants_higer_fig
-
-@app.callback(
-    Output('gender-histogram', 'figure'),
-    Input('selected-points', 'data')
-)
-
-def update_gender_histogram(selected_points):
-    if selected_points:
-        selected_df = df.iloc[selected_points]
-    else:
-        selected_df = df
-
-    studytime_fig = px.histogram(
-        selected_df,
-        x='sex',
-        title="Gender",
-        labels={'sex': 'Gender'},
-    )
-
-    studytime_fig.update_layout(
-        height=histogramHeight,
-        width=histogramWidth,
-        title_x=0.5,  
-        xaxis=dict(
-            title = "",
-            tickvals=[0, 1],
-            ticktext=["Female", "Male"],
-        ),
-        yaxis=dict(
-            title="",
-        ),
-        dragmode='select'
-    )
-
-    studytime_fig.update_traces(
-        marker=dict(color='blue')
-    )
-
-    return studytime_fig
-
-
-@app.callback(
-    Output('parents-together-histogram', 'figure'),
-    Input('selected-points', 'data')
-)
-
-def update_cohibition_histogram(selected_points):
-    if selected_points:
-        selected_df = df.iloc[selected_points]
-    else:
-        selected_df = df
-
-    cohibition_fig = px.histogram(
-        selected_df,
-        x='Pstatus',
-        title="Parents together",
-        labels={'Pstatus': 'Parents together'},
-    )
-
-    cohibition_fig.update_layout(
-        height=histogramHeight,
-        width=histogramWidth,
-        title_x=0.5,
-        xaxis=dict(
-            title = "",
-            tickvals=[0, 1],
-            ticktext=["Yes", "No"],
-        ),
-        yaxis=dict(
-            title="",
-        ),
-        dragmode='select'
-    )
-
-    cohibition_fig.update_traces(
-        marker=dict(color='blue')
-    )
-
-    return cohibition_fig
-
-@app.callback(
-    Output('grade-histogram', 'figure'),
-    Input('selected-points', 'data')
-)
-
-def update_grade_histogram(selected_points):
-    if selected_points:
-        selected_df = df.iloc[selected_points]
-    else:
-        selected_df = df
-
-    cohibition_fig = px.histogram(
-        selected_df,
-        x='G3',
-        title="Final grade",
-        labels={'Final grade': 'Final grade'},
-    )
-
-    cohibition_fig.update_layout(
-        height=histogramHeight,
-        width=histogramWidth * 2,
-        title_x=0.5,
-        xaxis=dict(
-            title = "",
-            range=[0, 20],  # Ensure the x-axis range is from 0 to 20
-        ),
-        yaxis=dict(
-            title="",
-        ),
-        dragmode='select'
-    )
-
-    cohibition_fig.update_traces(
-        marker=dict(color='blue')
-    )
-
-    return cohibition_fig
+        fig = go.Figure(go.Heatmap(
+            z=distribution, 
+            x=list(range(self.heatmap_bins.max_bins)),  
+            y=[heatmap_titles[attr] for attr in self.heatmap_bins.attributes], 
+            colorscale='Inferno',  
+            zmin=0, 
+            zmax=1,  
+            colorbar=dict(title='Relative Distribution'),
+            showscale=True,
+
+            texttemplate='%{text}',  
+            hoverinfo='text',  
+            hovertext=hover_text,  
+        ))
+
+        fig.update_layout(
+            title="Heatmap of Students' Attribute Bins (Normalized to Max 1)",
+            xaxis_title="Attribute Bins (0-4)",
+            yaxis_title="",
+            height=600,
+            width=800,
+        )
+
+        return fig
+
+    def create_histogram_figure(self, attribute, title, width, ticktext=None):
+        # Built once at load time: the bars are counts per value of the attribute, so selection
+        # changes only replace the bar heights and never ship the students' values to the browser
+        bin_masks = self.bin_masks[attribute]
+        fig = go.Figure(go.Bar(
+            x=bin_masks.values,
+            y=bin_masks.counts(),
+            marker=dict(color='blue'),
+        ))
+
+        xaxis = dict(title="")
+        if ticktext is not None:
+            xaxis.update(tickvals=list(bin_masks.values), ticktext=ticktext)
+        else:
+            xaxis.update(range=[-0.5, 20.5])  # Ensure the x-axis covers grades 0 to 20
+
+        fig.update_layout(
+            title=title,
+            height=histogramHeight,
+            width=width,
+            title_x=0.5,
+            xaxis=xaxis,
+            yaxis=dict(
+                title="",
+            ),
+            bargap=0,
+            dragmode='select'
+        )
+        return fig
+
+    def create_correlation(self, selected_points, gender_selected, wants_higher_selected, parents_together_selected, grade_selected):
+        # Correlations over the students in the t-SNE selection and under the histogram brushes
+        brushes = self.histogram_brushes(gender_selected, wants_higher_selected, parents_together_selected, grade_selected)
+        rows = self.selection_rows(selected_points, brushes)
+        return self.view_cache.get_or_compute(['correlation', memo.selection_key(len(self.df), rows)],
+                                              lambda: self.create_correlation_figure(self.correlation_blocks.correlation(rows)))
+
+    def create_correlation_figure(self, correlation):
+        columns = self.correlation_blocks.columns
+        fig = go.Figure(go.Heatmap(
+            z=np.round(correlation, 3),
+            x=columns,
+            y=columns,
+            colorscale='Viridis',
+            zmin=-1,
+            zmax=1,
+            colorbar=dict(title='Correlation'),
+            hovertemplate='%{y} and %{x}: %{z:.2f}<extra></extra>',
+        ))
+        fig.update_layout(
+            title="Correlation of Attributes in the Selection",
+            height=700,
+            width=800,
+        )
+        return fig
+
+    def create_parcoords(self, selected_points, gender_selected, wants_higher_selected, parents_together_selected, grade_selected):
+        brushes = self.histogram_brushes(gender_selected, wants_higher_selected, parents_together_selected, grade_selected)
+        rows = self.selection_rows(selected_points, brushes)
+        if rows is None:
+            rows = np.ones(len(self.df), dtype=bool)
+        return self.view_cache.get_or_compute(['parcoords', memo.selection_key(len(self.df), rows)],
+                                              lambda: self.create_parcoords_figure(rows))
+
+    def create_parcoords_figure(self, selected):
+        # One line per student up to PARCOORDS_LINE_LIMIT students. Above that, bands between the
+        # bins of neighbouring axes, as wide as the number of students they carry, and a sample of
+        # lines stratified by final grade. Both come from the axis bin codes, not from the rows.
+        axis_bins = self.axis_bins
+        n_axes = len(axis_bins.attributes)
+        positions = [axis_bins.positions(axis) for axis in range(n_axes)]
+        fig = go.Figure()
+
+        if np.count_nonzero(selected) > PARCOORDS_LINE_LIMIT:
+            segments = []  # (count, axis, y on the axis, y on the next axis)
+            for axis, counts in enumerate(axis_bins.pair_counts(selected)):
+                for a, b in zip(*np.nonzero(counts)):
+                    segments.append((counts[a, b], axis, positions[axis][a], positions[axis + 1][b]))
+            max_count = max(count for count, _, _, _ in segments)
+
+            # Bands are drawn in a few width levels, one trace each
+            for level in range(PARCOORDS_BAND_LEVELS):
+                band = [segment for segment in segments
+                        if min(int(segment[0] / max_count * PARCOORDS_BAND_LEVELS), PARCOORDS_BAND_LEVELS - 1) == level]
+                if band:
+                    fig.add_trace(go.Scatter(
+                        x=[x for _, axis, _, _ in band for x in (axis, axis + 1, None)],
+                        y=[y for _, _, y0, y1 in band for y in (y0, y1, None)],
+                        mode='lines', line=dict(width=2 + 4 * level, color='steelblue'), opacity=0.15 + 0.15 * level,
+                        hoverinfo='skip', showlegend=False,
+                    ))
+            rows = axis_bins.sample(selected, PARCOORDS_SAMPLE, axis_bins.attributes.index('G3'))
+        else:
+            rows = np.flatnonzero(selected)
+
+        if len(rows):
+            y = np.column_stack([positions[axis][axis_bins.codes[rows, axis]] for axis in range(n_axes)] + [np.full(len(rows), np.nan)])
+            fig.add_trace(go.Scatter(
+                x=np.tile(np.append(np.arange(n_axes, dtype=float), np.nan), len(rows)), y=y.ravel(),
+                mode='lines', line=dict(width=1, color='rgba(40, 40, 40, 0.3)'), hoverinfo='skip', showlegend=False,
+            ))
+
+        # Invisible markers on every bin make box selection available for brushing axis ranges
+        fig.add_trace(go.Scatter(
+            x=[axis for axis in range(n_axes) for _ in positions[axis]],
+            y=[y for axis in range(n_axes) for y in positions[axis]],
+            text=[f'{label}: {bin_label}' for axis, label in enumerate(parcoords_labels.values())
+                  for bin_label in axis_bins.bin_labels(axis)],
+            mode='markers', marker=dict(size=8, color='black', opacity=0), hoverinfo='text', showlegend=False,
+        ))
+
+        fig.update_layout(
+            title="Parallel Coordinates of the Selection",
+            height=450,
+            width=1400,
+            dragmode='select',
+            xaxis=dict(tickvals=list(range(n_axes)), ticktext=list(parcoords_labels.values()), showgrid=False, zeroline=False),
+            yaxis=dict(visible=False, range=[-0.05, 1.05]),
+            shapes=[dict(type='line', x0=axis, x1=axis, y0=0, y1=1, line=dict(color='grey', width=1)) for axis in range(n_axes)],
+            uirevision='parcoords',
+        )
+        return fig
+
+    def store_parcoords_selection(self, selected_data):
+        # A box over one or more axes brushes the bins inside its vertical range on each of them,
+        # resolved against every student on the server
+        if not selected_data:
+            return dash.no_update
+        region = selected_data.get('range')
+        if region:
+            (x0, x1), (y0, y1) = region['x'], region['y']
+        elif selected_data.get('lassoPoints'):
+            lasso = selected_data['lassoPoints']
+            (x0, x1), (y0, y1) = (min(lasso['x']), max(lasso['x'])), (min(lasso['y']), max(lasso['y']))
+        else:
+            return dash.no_update
+        n_axes = len(self.axis_bins.attributes)
+        axes = [axis for axis in range(n_axes) if min(x0, x1) <= axis <= max(x0, x1)]
+        if not axes:
+            return dash.no_update  # Drawn between or beyond the axes, so it brushes nothing
+
+        # An empty brush is kept as an empty selection, which the views draw as no students
+        selected = self.axis_bins.brush_mask({axis: (y0, y1) for axis in axes})
+        return selection.encode_selection(selected, self.dataset_version)
+
+    def display_quartiles(self, selected_points, column, gender_selected, wants_higher_selected, parents_together_selected, grade_selected):
+        brushes = self.histogram_brushes(gender_selected, wants_higher_selected, parents_together_selected, grade_selected)
+        quartiles = self.quantiles.quartiles(column, self.selection_rows(selected_points, brushes))
+        if not quartiles['count']:
+            return f"{quantile_columns[column]}: no students selected."
+        return (f"{quantile_columns[column]} of {quartiles['count']} students: Q1 {quartiles['q1']:g}, "
+                f"median {quartiles['median']:g}, Q3 {quartiles['q3']:g}, "
+                f"outliers below {quartiles['lower_bound']:g} or above {quartiles['upper_bound']:g}")
+
+    def apply_quantile_filter(self, filter_name, column, selected_points, gender_selected, wants_higher_selected,
+                              parents_together_selected, grade_selected):
+        # Narrows the stored selection to the students in the chosen range of the quartiles of the
+        # current selection, then clears the choice so the same filter can be applied again. The
+        # histogram brushes only shape the quartiles; they stay separate from the stored selection.
+        if not filter_name:
+            return dash.no_update, dash.no_update
+        brushes = self.histogram_brushes(gender_selected, wants_higher_selected, parents_together_selected, grade_selected)
+        selected = self.quantiles.filter_mask(column, filter_name, self.selection_rows(selected_points, brushes))
+        stored = selection.decode_selection(selected_points, self.dataset_version)
+        if stored is not None:
+            selected = selected & stored
+        # Kept even when empty, so a filter matching nobody shows an empty selection and not everyone
+        return selection.encode_selection(selected, self.dataset_version), None
+
+    def create_histogram_figures(self):
+        return {
+            'higher': self.create_histogram_figure('higher', "Wants higher education", histogramWidth, ["No", "Yes"]),
+            'sex': self.create_histogram_figure('sex', "Gender", histogramWidth, ["Female", "Male"]),
+            'Pstatus': self.create_histogram_figure('Pstatus', "Parents together", histogramWidth, ["Yes", "No"]),
+            'G3': self.create_histogram_figure('G3', "Final grade", histogramWidth * 2),
+        }
+
+    def store_selected_points(self, selected_data):
+
+        if selected_data:
+            # Box and lasso selections are resolved on the server against every student, since
+            # in density mode the points the client drew are raster cells and not students
+            selected = self.tsne_index().region_mask(selected_data)
+            if selected is None:
+                selected = np.zeros(len(self.df), dtype=bool)
+                selected[[point['pointIndex'] for point in selected_data['points']]] = True
+            # Stored as a compact bitset rather than a list of row indices, see selection.encode_selection
+            if selected.any():
+                return selection.encode_selection(selected, self.dataset_version)
+        
+        return None
+
+    def display_selected_points(self, selected_points):
+        if selection.decode_selection(selected_points, self.dataset_version) is not None:
+            count = selection.selection_count(selected_points, self.dataset_version)
+            return f"Selected Points: {count} ({100 * (count / len(self.df)):.2f}%)"
+        return "No points selected."
+
+    def patch_histogram(self, attribute, selected_points, brushes):
+        # Each histogram counts the students under the brushes on the other histograms, from the
+        # count cube, and within the t-SNE selection by a row scan
+        rows = selection.decode_selection(selected_points, self.dataset_version)
+        if rows is not None:
+            rows = self.brushed_rows(rows, brushes, skip=attribute)
+
+        def create_patch():
+            patched_fig = Patch()
+            if rows is None:
+                patched_fig['data'][0]['y'] = self.count_cube.histogram_counts(attribute, brushes)
+            else:
+                patched_fig['data'][0]['y'] = self.bin_masks[attribute].counts(rows)
+            return patched_fig
+
+        key = self.brushes_key(brushes) if rows is None else memo.selection_key(len(self.df), rows)
+        return self.view_cache.get_or_compute(['histogram', attribute, key], create_patch)
+
+    def update_higher_histogram(self, selected_points, gender_selected, parents_together_selected, grade_selected):
+        brushes = self.histogram_brushes(gender_selected, None, parents_together_selected, grade_selected)
+        return self.patch_histogram('higher', selected_points, brushes)
+
+    def update_gender_histogram(self, selected_points, wants_higher_selected, parents_together_selected, grade_selected):
+        brushes = self.histogram_brushes(None, wants_higher_selected, parents_together_selected, grade_selected)
+        return self.patch_histogram('sex', selected_points, brushes)
+
+    def update_cohibition_histogram(self, selected_points, gender_selected, wants_higher_selected, grade_selected):
+        brushes = self.histogram_brushes(gender_selected, wants_higher_selected, None, grade_selected)
+        return self.patch_histogram('Pstatus', selected_points, brushes)
+
+    def update_grade_histogram(self, selected_points, gender_selected, wants_higher_selected, parents_together_selected):
+        brushes = self.histogram_brushes(gender_selected, wants_higher_selected, parents_together_selected, None)
+        return self.patch_histogram('G3', selected_points, brushes)
+
+    # App layout
+    ##  ------------------------------------------------------------------------------
+
+    def serve_layout(self):
+        # Built per page load so a new visitor gets the current embedding without a second round trip
+        embedding_options = self.embedding_options()
+        return html.Div([
+            html.H1("Interactive t-SNE Visualization"),
+            dcc.Dropdown(id='embedding', options=embedding_options, value=self.embedding_name, clearable=False,
+                         style={'width': '800px', 'display': 'block' if len(embedding_options) > 1 else 'none'}),
+            html.Div([
+                dcc.Graph(id='gender-histogram', figure=self.histogram_figures['sex'], style={'height': '150px', 'width': '240px'}),
+                dcc.Graph(id='wants-higher-histogram', figure=self.histogram_figures['higher'], style={'height': '150px', 'width': '240px'}),
+                dcc.Graph(id='parents-together-histogram', figure=self.histogram_figures['Pstatus'], style={'height': '150px', 'width': '240px'}),
+                dcc.Graph(id='grade-histogram', figure=self.histogram_figures['G3'], style={'height': '150px', 'width': '540px'}),
+            ], style={'display': 'flex', 'flex-direction': 'row', 'height': '350px'}),
+            html.Div([
+                dcc.Graph(id='tsne-plot', 
+                            figure=self.create_tsne_figure(np.ones(len(self.df), dtype=bool)), 
+                            style={'height': '600px', 'width': '800px'},
+                            config={'displayModeBar': True},  
+                          ),
+                dcc.Graph(id='heatmap', style={'height': '600px', 'width': '600px'}), 
+            ], style={'display': 'flex', 'flex-direction': 'row'}),
+            html.Div([
+                dcc.Dropdown(id='quantile-column', options=[{'label': label, 'value': column} for column, label in quantile_columns.items()],
+                             value='G3', clearable=False, style={'width': '240px'}),
+                dcc.RadioItems(id='quantile-filter', options=[{'label': label, 'value': name} for name, label in quantile_filters.items()],
+                               value=None, inline=True, style={'margin': '10px'}),
+                html.Div(id='quantile-summary', style={'margin': '10px'}),
+            ], style={'display': 'flex', 'flex-direction': 'row', 'align-items': 'center'}),
+            dcc.Graph(id='parcoords', style={'height': '450px', 'width': '1400px'}),
+            dcc.Graph(id='correlation', style={'height': '700px', 'width': '800px'}),
+            dcc.Store(id='selected-points', data=None),  
+            dcc.Store(id='embedding-version', data=self.embedding_token()),
+            dcc.Store(id='tsne-view', data=None),
+            dcc.Interval(id='embedding-poll', interval=EMBEDDING_POLL_MS, disabled=self.embedding_job.done),
+            dcc.Store(id='dataset-version', data=self.dataset_version),
+            dcc.Interval(id='data-poll', interval=DATA_POLL_MS, disabled=self.data_watch is None),
+            html.Div(id='selection-output'), 
+        ])
+
+    ##  ------------------------------------------------------------------------------
+
+
+def dataset_paths(paths):
+    # Datasets are named after their file, e.g. data/cohorts/math-2024.csv is 'math-2024'
+    return {os.path.splitext(os.path.basename(path))[0]: path for path in paths}
+
+
+def default_datasets(data_path=DATA_PATH):
+    if DATASETS_PATTERN:
+        return dataset_paths(sorted(glob.glob(DATASETS_PATTERN)))
+    return dataset_paths([data_path])
+
+
+def serve_layout(datasets, dataset_names):
+    # Every page starts on the first dataset; picking another one replaces the whole dashboard below the picker
+    return html.Div([
+        dcc.Dropdown(id='dataset', options=dataset_names, value=dataset_names[0], clearable=False,
+                     style={'width': '400px', 'display': 'block' if len(dataset_names) > 1 else 'none'}),
+        html.Div(id='dashboard', children=datasets.get(dataset_names[0]).serve_layout()),
+    ])
+
+
+def dispatch(datasets, name, check_data=False):
+    # Callbacks get the picked dataset and embedding as their last arguments and run on that
+    # dataset's Dashboard, holding its state lock so a data change is never half seen. A data
+    # change is applied before the lock is taken, since publishing it waits for the readers.
+    def callback(*args):
+        *args, dataset, embedding_name = args
+        dashboard = datasets.get(dataset)
+        changed = check_data and dashboard.check_data()
+        n_views = len(dashboard._embedding_views)
+        with dashboard._state_lock.read():
+            result = getattr(dashboard.for_embedding(embedding_name), name)(*args)
+        # The pool only measures a dashboard again when it grew: new data or another embedding loaded
+        if changed or len(dashboard._embedding_views) != n_views:
+            datasets.resize(dataset)
+        return result
+
+    callback.__name__ = name
+    return callback
+
+
+def register_callbacks(app, datasets):
+    dataset = [State('dataset', 'value'), State('embedding', 'value')]
+
+    app.callback(
+        Output('dashboard', 'children'),
+        Input('dataset', 'value'),
+        State('embedding', 'value'),  # Sweep keys include the data file, so the new dataset starts on its default embedding
+        prevent_initial_call=True
+    )(dispatch(datasets, 'serve_layout'))
+
+    app.callback(
+        Output('tsne-plot', 'figure'),
+        [Input('selected-points', 'data'),
+         Input('gender-histogram', 'selectedData'),
+         Input('wants-higher-histogram', 'selectedData'),
+         Input('parents-together-histogram', 'selectedData'),
+         Input('grade-histogram', 'selectedData')
+         ],
+        [State('tsne-view', 'data'), dataset],
+        prevent_initial_call=True
+    )(dispatch(datasets, 'update_tsne_plot'))
+
+    app.callback(
+        Output('tsne-plot', 'figure', allow_duplicate=True),
+        [Input('embedding-version', 'data'),
+         Input('tsne-view', 'data')
+         ],
+        [State('selected-points', 'data'),
+         State('gender-histogram', 'selectedData'),
+         State('wants-higher-histogram', 'selectedData'),
+         State('parents-together-histogram', 'selectedData'),
+         State('grade-histogram', 'selectedData'),
+         dataset
+         ],
+        prevent_initial_call=True
+    )(dispatch(datasets, 'refresh_tsne_plot'))
+
+    app.callback(
+        Output('tsne-view', 'data'),
+        Input('tsne-plot', 'relayoutData'),
+        [State('tsne-view', 'data'), dataset],
+        prevent_initial_call=True
+    )(dispatch(datasets, 'update_tsne_view'))
+
+    app.callback(
+        [Output('embedding-version', 'data'),
+         Output('embedding-poll', 'disabled')],
+        Input('embedding-poll', 'n_intervals'),
+        [State('embedding-version', 'data'), dataset]
+    )(dispatch(datasets, 'poll_embedding'))
+
+    app.callback(
+        [Output('embedding-version', 'data', allow_duplicate=True),
+         Output('embedding-poll', 'disabled', allow_duplicate=True),
+         Output('tsne-view', 'data', allow_duplicate=True),
+         Output('selected-points', 'data', allow_duplicate=True)],
+        Input('embedding', 'value'),
+        dataset,
+        prevent_initial_call=True
+    )(dispatch(datasets, 'select_embedding'))
+
+    app.callback(
+        [Output('dataset-version', 'data'),
+         Output('gender-histogram', 'figure', allow_duplicate=True),
+         Output('wants-higher-histogram', 'figure', allow_duplicate=True),
+         Output('parents-together-histogram', 'figure', allow_duplicate=True),
+         Output('grade-histogram', 'figure', allow_duplicate=True),
+         Output('embedding', 'options'),
+         Output('embedding', 'value'),
+         Output('embedding-version', 'data', allow_duplicate=True),
+         Output('embedding-poll', 'disabled', allow_duplicate=True),
+         Output('selected-points', 'data', allow_duplicate=True)],
+        Input('data-poll', 'n_intervals'),
+        [State('dataset-version', 'data'), dataset],
+        prevent_initial_call=True
+    )(dispatch(datasets, 'poll_data', check_data=True))
+
+    app.callback(
+        Output('heatmap', 'figure'),
+        [Input('selected-points', 'data'),
+         Input('gender-histogram', 'selectedData'),
+         Input('wants-higher-histogram', 'selectedData'),
+         Input('parents-together-histogram', 'selectedData'),
+         Input('grade-histogram', 'selectedData')
+         ],
+        dataset
+    )(dispatch(datasets, 'create_heatmap'))
+
+    app.callback(
+        Output('correlation', 'figure'),
+        [Input('selected-points', 'data'),
+         Input('gender-histogram', 'selectedData'),
+         Input('wants-higher-histogram', 'selectedData'),
+         Input('parents-together-histogram', 'selectedData'),
+         Input('grade-histogram', 'selectedData')
+         ],
+        dataset
+    )(dispatch(datasets, 'create_correlation'))
+
+    app.callback(
+        Output('parcoords', 'figure'),
+        [Input('selected-points', 'data'),
+         Input('gender-histogram', 'selectedData'),
+         Input('wants-higher-histogram', 'selectedData'),
+         Input('parents-together-histogram', 'selectedData'),
+         Input('grade-histogram', 'selectedData')
+         ],
+        dataset
+    )(dispatch(datasets, 'create_parcoords'))
+
+    app.callback(
+        Output('selected-points', 'data', allow_duplicate=True),
+        Input('parcoords', 'selectedData'),
+        dataset,
+        prevent_initial_call=True
+    )(dispatch(datasets, 'store_parcoords_selection'))
+
+    app.callback(
+        Output('quantile-summary', 'children'),
+        [Input('selected-points', 'data'),
+         Input('quantile-column', 'value'),
+         Input('gender-histogram', 'selectedData'),
+         Input('wants-higher-histogram', 'selectedData'),
+         Input('parents-together-histogram', 'selectedData'),
+         Input('grade-histogram', 'selectedData')
+         ],
+        dataset
+    )(dispatch(datasets, 'display_quartiles'))
+
+    app.callback(
+        [Output('selected-points', 'data', allow_duplicate=True),
+         Output('quantile-filter', 'value')],
+        Input('quantile-filter', 'value'),
+        [State('quantile-column', 'value'),
+         State('selected-points', 'data'),
+         State('gender-histogram', 'selectedData'),
+         State('wants-higher-histogram', 'selectedData'),
+         State('parents-together-histogram', 'selectedData'),
+         State('grade-histogram', 'selectedData'),
+         dataset
+         ],
+        prevent_initial_call=True
+    )(dispatch(datasets, 'apply_quantile_filter'))
+
+    app.callback(
+        Output('selected-points', 'data'),
+        [Input('tsne-plot', 'selectedData'),
+         ],
+        dataset
+    )(dispatch(datasets, 'store_selected_points'))
+
+    app.callback(
+        Output('selection-output', 'children'),
+        Input('selected-points', 'data'),
+        dataset
+    )(dispatch(datasets, 'display_selected_points'))
+
+    # Every histogram follows the t-SNE selection and the brushes on the other histograms
+    histogram_ids = ['gender-histogram', 'wants-higher-histogram', 'parents-together-histogram', 'grade-histogram']
+    for output_id, name in [('wants-higher-histogram', 'update_higher_histogram'),
+                            ('gender-histogram', 'update_gender_histogram'),
+                            ('parents-together-histogram', 'update_cohibition_histogram'),
+                            ('grade-histogram', 'update_grade_histogram')]:
+        app.callback(
+            Output(output_id, 'figure'),
+            [Input('selected-points', 'data')] + [Input(other_id, 'selectedData') for other_id in histogram_ids if other_id != output_id],
+            dataset,
+            prevent_initial_call=True
+        )(dispatch(datasets, name))
+
+
+def create_app(data_path=DATA_PATH, datasets=None, memory_budget=MEMORY_BUDGET_BYTES, watch=WATCH_DATA):
+    # App factory: all state lives in the Dashboards, so every call gives an independent app.
+    # datasets maps the names shown in the picker to data files, each gets its own Dashboard
+    # built on first use and dropped again when the pool goes over the memory budget.
+    if datasets is None:
+        datasets = default_datasets(data_path)
+    dataset_names = list(datasets)
+    pool = memo.LazyPool(lambda name: Dashboard(datasets[name], watch), memory_budget,
+                         size=Dashboard.memory_bytes, name='datasets')
+
+    app = dash.Dash(__name__)
+    app.datasets = pool
+    metrics.instrument(app)  # Per-callback metrics served on /metrics, disabled with VA_METRICS=0
+    app.layout = lambda: serve_layout(pool, dataset_names)
+    register_callbacks(app, pool)
+    return app
+
+
+def create_server(data_path=DATA_PATH):
+    # WSGI entry point, e.g. gunicorn --workers 4 --preload 'vaSystem:create_server()'
+    return create_app(data_path).server
+
 
 if __name__ == '__main__':
-    app.run_server(debug=True)
+    create_app().run(debug=True)